@@ -0,0 +1,56 @@
+'''
+Following a big tree through the event bus instead of scanning it
+Boots the tree with no subscriber, a queue subscriber that never reads (it drops), and a callback
+subscriber, and compares the boot times and the changes each of them got
+python benchmarks/bench_events.py [n_leaves]
+'''
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import exectree.simple as ET
+from exectree import events
+from rich.console import Console
+from bench_memory import make_config
+
+
+def user_on_enter_nothing(self):
+    pass
+
+
+def time_boot(n_leaves, console, subscribe=None):
+    top = ET.load(json.dumps(make_config(n_leaves, n_per_node=100)), console, use_cache=False)
+    top.create_fsms()
+    subscription = subscribe() if subscribe else None
+    start = time.perf_counter()
+    top.send_command("boot")
+    while top.state in ["none", "boot_ing"]:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    top.quit()
+    if subscription is not None:
+        time.sleep(0.1) # the callbacks are a bit behind
+        subscription.close()
+    return elapsed, subscription
+
+
+if __name__ == "__main__":
+    for trigger in ["boot", "init", "conf", "start"]:
+        setattr(ET.ExecLeaf, f"user_on_enter_{trigger}_ing", user_on_enter_nothing)
+    n_leaves = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    console = Console(quiet=True)
+    received = []
+
+    elapsed, _ = time_boot(n_leaves, console)
+    print(f"{n_leaves} leaves, no subscriber:     boot in {elapsed:.2f}s")
+
+    elapsed, subscription = time_boot(n_leaves, console, lambda: events.subscribe(max_pending=1000))
+    print(f"{n_leaves} leaves, stalled queue:     boot in {elapsed:.2f}s, "
+          f"{len(subscription.pending)} changes kept, {subscription.dropped} dropped")
+
+    elapsed, subscription = time_boot(n_leaves, console, lambda: events.subscribe(callback=received.extend, max_pending=100000))
+    print(f"{n_leaves} leaves, callback:          boot in {elapsed:.2f}s, "
+          f"{len(received)} changes received, {subscription.dropped} dropped")
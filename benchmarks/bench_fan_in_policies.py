@@ -0,0 +1,60 @@
+'''
+Time for a node to decide on a transition, depending on its fan-in policy
+One of the children fails early, the others take between 0 and max_latency seconds
+python benchmarks/bench_fan_in_policies.py [n_leaves] [max_latency]
+'''
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import exectree.simple as ET
+from rich.console import Console
+
+
+MAX_LATENCY = 2.
+
+
+def user_on_enter_boot_ing(self):
+    if self.name == "app0":
+        time.sleep(0.01)
+        raise RuntimeError("app0 is broken")
+    time.sleep(random.uniform(0, MAX_LATENCY))
+
+
+def make_config(n_leaves, transition_conf):
+    return {
+        "top": {
+            "states": ["none", "booted"],
+            "transitions": [{"trigger": "boot", "source": "none", "dest": "booted"}],
+            "transition-conf": transition_conf,
+            "children": {f"app{i}": "app" for i in range(n_leaves)}
+        }
+    }
+
+
+def time_boot(n_leaves, transition_conf, console):
+    top = ET.load(json.dumps(make_config(n_leaves, transition_conf)), console)
+    top.create_fsms()
+    start = time.perf_counter()
+    top.send_command("boot")
+    while top.state == "boot_ing" or top.state == "none":
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    state = top.state
+    top.quit(timeout=MAX_LATENCY*2)
+    return elapsed, state
+
+
+if __name__ == "__main__":
+    n_leaves = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    MAX_LATENCY = float(sys.argv[2]) if len(sys.argv) > 2 else MAX_LATENCY
+    ET.ExecLeaf.user_on_enter_boot_ing = user_on_enter_boot_ing
+    console = Console(quiet=True)
+
+    for transition_conf in ["strict", "complaisant", "quorum=99%", f"quorum={n_leaves}"]:
+        elapsed, state = time_boot(n_leaves, transition_conf, console)
+        print(f"{transition_conf:>15}: {state:>8} after {elapsed:.3f}s")
@@ -0,0 +1,39 @@
+'''
+Cold start of the package: time to import it in a fresh interpreter, and what it drags in
+Exits with an error if it gets slower than the budget, or if rich gets imported without printing anything
+python benchmarks/bench_import.py [budget_ms]
+'''
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+import exectree.simple
+elapsed = time.perf_counter() - start
+heavy = [m for m in ["rich", "transitions.extensions", "exectree.render"] if m in sys.modules]
+print(elapsed, ",".join(heavy))
+'''
+
+
+def cold_import(n_runs=10):
+    times = []
+    for _ in range(n_runs):
+        output = subprocess.run([sys.executable, "-c", SCRIPT], cwd=ROOT, capture_output=True, text=True, check=True).stdout.split()
+        times.append(float(output[0]))
+        heavy = output[1] if len(output) > 1 else ""
+    return statistics.median(times), heavy
+
+
+if __name__ == "__main__":
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 100.
+    elapsed, heavy = cold_import()
+    print(f"import exectree.simple: {elapsed*1000:.1f} ms (budget {budget:.0f} ms)")
+    if heavy:
+        sys.exit(f"heavy modules imported eagerly: {heavy}")
+    if elapsed*1000 > budget:
+        sys.exit("cold start over budget")
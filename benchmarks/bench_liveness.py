@@ -0,0 +1,66 @@
+'''
+Cost of watching the liveness of a huge tree (see exectree/liveness.py): the leaves are "started" and
+healthy, the single liveness thread checks each of them every interval
+python benchmarks/bench_liveness.py [n_leaves] [interval] [seconds]
+'''
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import exectree.simple as ET
+from exectree import liveness
+from bench_memory import make_config
+
+
+class Silent():
+    ## Even a quiet rich console formats what it's given
+    def log(self, *args, **kwargs):
+        pass
+
+    def print(self, *args, **kwargs):
+        pass
+
+
+checks = 0
+
+
+def user_health_check(self):
+    global checks
+    checks += 1
+    return True
+
+
+def user_on_enter_nothing(self):
+    pass
+
+
+if __name__ == "__main__":
+    n_leaves = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    interval = float(sys.argv[2]) if len(sys.argv) > 2 else 1.
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 10.
+    for trigger in ["boot", "init", "conf", "start"]:
+        setattr(ET.ExecLeaf, f"user_on_enter_{trigger}_ing", user_on_enter_nothing)
+    ET.ExecLeaf.user_health_check = user_health_check
+
+    config = make_config(n_leaves)
+    config["top"]["heartbeat"] = {"interval": interval, "misses": 3}
+    top = ET.load(json.dumps(config), Silent(), use_cache=False)
+    start = time.perf_counter()
+    top.create_fsms()
+    print(f"{n_leaves} leaves, watched in {time.perf_counter()-start:.2f} s (create_fsms included), "
+          f"{threading.active_count()} thread(s)")
+    # no command, so no command sender threads: only the liveness thread is running
+    for node in [top] + list(top.descendants):
+        node.fsm.set_state("started", model=node)
+
+    cpu, wall, checks = time.process_time(), time.perf_counter(), 0
+    time.sleep(seconds)
+    cpu, wall = time.process_time()-cpu, time.perf_counter()-wall
+    errors = sum(leaf.state == "error" for leaf in top.leaves)
+    print(f"{checks/wall:.0f} checks/s (expected {n_leaves/interval:.0f}), "
+          f"{cpu/wall*100:.1f}% of a CPU, {cpu/max(checks, 1)*1e6:.1f} us per check, {errors} leaves on error")
+    liveness.monitor.stop()
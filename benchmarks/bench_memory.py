@@ -0,0 +1,58 @@
+'''
+Memory used by a huge tree, as seen by tracemalloc and by memory_report()
+python benchmarks/bench_memory.py [n_leaves]
+'''
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import exectree.simple as ET
+from rich.console import Console
+
+
+def make_config(n_leaves, n_per_node=1000):
+    groups = {}
+    for i in range(0, n_leaves, n_per_node):
+        groups[f"group{i//n_per_node}"] = {
+            "children": {f"app{j}": "app" for j in range(i, min(i+n_per_node, n_leaves))}
+        }
+    return {
+        "top": {
+            "states": ["none", "booted", "initialised", "configured", "started"],
+            "transitions": [{"trigger": "boot" , "source": "none"       , "dest": "booted"     },
+                            {"trigger": "init" , "source": "booted"     , "dest": "initialised"},
+                            {"trigger": "conf" , "source": "initialised", "dest": "configured" },
+                            {"trigger": "start", "source": "configured" , "dest": "started"    }],
+            "children": groups
+        }
+    }
+
+
+def user_on_enter_nothing(self):
+    pass
+
+
+if __name__ == "__main__":
+    for trigger in ["boot", "init", "conf", "start"]:
+        setattr(ET.ExecLeaf, f"user_on_enter_{trigger}_ing", user_on_enter_nothing)
+    n_leaves = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    console = Console(quiet=True)
+    config = json.dumps(make_config(n_leaves))
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    top = ET.load(config, console)
+    top.create_fsms()
+    elapsed = time.perf_counter() - start
+    traced, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    n_nodes = len(top.descendants) + 1
+    print(f"{n_nodes} nodes built in {elapsed:.1f}s, {traced/2**20:.1f} MB traced, {traced/n_nodes:.0f} B/node")
+    report = ET.memory_report(top)
+    for name, klass in report["by_class"].items():
+        print(f"  {name}: {klass['nodes']} nodes, {klass['bytes_per_node']:.0f} B/node according to memory_report()")
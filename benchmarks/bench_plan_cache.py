@@ -0,0 +1,37 @@
+'''
+Time to get the plan of a big configuration: compiled from the json vs read from the plan cache
+python benchmarks/bench_plan_cache.py [n_leaves]
+'''
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from exectree import cache, plan
+from bench_memory import make_config
+
+
+if __name__ == "__main__":
+    n_leaves = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    text = json.dumps(make_config(n_leaves))
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        start = time.perf_counter()
+        compiled = plan.compile_config(json.loads(text))
+        compile_time = time.perf_counter() - start
+
+        cache.store_plan(compiled, text, cache_dir)
+        size = os.path.getsize(os.path.join(cache_dir, cache.config_hash(text)+".plan"))
+
+        plan._fsm_plans.clear() # as in a fresh process
+        start = time.perf_counter()
+        cached = cache.load_plan(text, cache_dir)
+        cached_time = time.perf_counter() - start
+
+    assert cached == compiled, "the cached plan differs from the compiled one"
+    print(f"{n_leaves} leaves, cache file {size/1e6:.1f} MB")
+    print(f"compiled from json: {compile_time*1e3:8.1f} ms")
+    print(f"from the cache:     {cached_time*1e3:8.1f} ms ({compile_time/cached_time:.1f}x faster)")
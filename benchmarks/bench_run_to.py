@@ -0,0 +1,47 @@
+'''
+Time to get a big tree from none to started (on the virtual clock, see exectree/simulation.py):
+one command per step vs run_to, with a slow leaf in a different group at each step
+python benchmarks/bench_run_to.py [n_leaves]
+'''
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from exectree.simulation import Simulation, Script
+from bench_memory import make_config
+
+
+STEPS = ["boot", "init", "conf", "start"]
+
+
+if __name__ == "__main__":
+    n_leaves = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    n_per_node = 1000
+    scripts = {
+        f"top/group{i}/app{i*n_per_node+1}": {step: Script(latency=5.)}
+        for i, step in enumerate(STEPS)
+    }
+    scripts["*"] = Script(latency=lambda rng: rng.expovariate(4.))
+
+    for barrier in [None, "conf"]:
+        config = make_config(n_leaves, n_per_node)
+        for transition in config["top"]["transitions"]:
+            if transition["trigger"] == barrier:
+                transition["barrier"] = True
+        sim = Simulation(json.dumps(config), scripts=scripts)
+
+        start = time.perf_counter()
+        step_by_step = sum(sim.command(step)["elapsed"] for step in STEPS)
+        wall = time.perf_counter() - start
+        print(f"{n_leaves} leaves, barrier at {barrier}")
+        print(f"  one command per step: {step_by_step:6.2f} virtual s ({wall:.1f} s wall)")
+
+        sim.reset()
+        start = time.perf_counter()
+        result = sim.run_to("started")
+        wall = time.perf_counter() - start
+        assert result["state"] == "started", result
+        print(f"  run_to:               {result['elapsed']:6.2f} virtual s ({wall:.1f} s wall)")
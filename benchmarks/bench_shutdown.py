@@ -0,0 +1,52 @@
+'''
+Time it takes to tear down a wide tree with shutdown(), once booted so that every node has its thread
+python benchmarks/bench_shutdown.py [n_leaves]
+'''
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import exectree.simple as ET
+from rich.console import Console
+
+
+def make_config(n_leaves, n_per_node=100):
+    groups = {}
+    for i in range(0, n_leaves, n_per_node):
+        groups[f"group{i//n_per_node}"] = {
+            "children": {f"app{j}": "app" for j in range(i, min(i+n_per_node, n_leaves))}
+        }
+    return {
+        "top": {
+            "states": ["none", "booted"],
+            "transitions": [{"trigger": "boot", "source": "none", "dest": "booted"}],
+            "children": groups
+        }
+    }
+
+
+def user_on_enter_nothing(self):
+    pass
+
+
+if __name__ == "__main__":
+    n_leaves = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    ET.ExecLeaf.user_on_enter_boot_ing = user_on_enter_nothing
+    console = Console(quiet=True)
+    top = ET.load(json.dumps(make_config(n_leaves)), console)
+    n_nodes = len(top.descendants) + 1
+    top.create_fsms()
+    # the command sender threads are only started with the first command
+    result = top.run_to("booted", timeout=600.)
+    n_threads = sum(node._command_sender is not None for node in [top] + list(top.descendants))
+    print(f"booted {n_nodes} nodes: {result['state']} in {result['elapsed']:.2f}s, {n_threads} command threads, "
+          f"{threading.active_count()} threads in all")
+
+    start = time.perf_counter()
+    stuck = ET.shutdown(top, timeout=10.)
+    elapsed = time.perf_counter() - start
+    print(f"shutdown of {n_nodes} nodes: {elapsed:.3f}s, {len(stuck)} stuck")
@@ -0,0 +1,33 @@
+'''
+Scenarios on a big simulated tree (see exectree/simulation.py): virtual seconds vs wall clock seconds
+python benchmarks/bench_simulation.py [n_leaves] [n_scenarios]
+'''
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from exectree.simulation import Simulation, Script
+from bench_memory import make_config
+
+
+if __name__ == "__main__":
+    n_leaves = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    n_scenarios = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    start = time.perf_counter()
+    sim = Simulation(json.dumps(make_config(n_leaves)), scripts={
+        "top/group0/app7": {"conf": Script(latency=20)}, # slower than the 15s the groups wait
+        "*": Script(latency=lambda rng: rng.expovariate(4.), failure_rate=1e-5),
+    })
+    print(f"{n_leaves} leaves, built in {time.perf_counter()-start:.2f} s")
+
+    for seed in range(n_scenarios):
+        sim.reset(seed)
+        start = time.perf_counter()
+        results = [(trigger, sim.command(trigger)) for trigger in ["boot", "init", "conf"]]
+        wall = time.perf_counter() - start
+        steps = ", ".join(f"{trigger} -> {r['state']} in {r['elapsed']:.2f}s" for trigger, r in results)
+        print(f"seed {seed}: {steps} (virtual {sim.now:.1f} s, wall {wall:.2f} s)")
@@ -0,0 +1,39 @@
+'''
+Trees of FSMs, where every node forwards the commands it receives to its children
+
+Nothing is imported until it is used, so that scripts that only send a command don't pay for
+the whole package: `exectree.simple` holds the nodes with a status queue (the default engine),
+`exectree.executable` the nodes with long and short transitions, `exectree.render` the printouts,
+`exectree.plan` the checks and compilation of the configuration
+'''
+import importlib
+
+__version__ = "0.1.0"
+
+_exports = {
+    "ExecNode": "simple",
+    "ExecLeaf": "simple",
+    "FSMConfig": "simple",
+    "CallbackTimeout": "simple",
+    "load": "simple",
+    "loads": "simple",
+    "node_memory": "simple",
+    "memory_report": "simple",
+    "ConfigError": "plan",
+    "compile_config": "plan",
+    "CommandSender": "sender",
+    "shutdown": "sender",
+}
+
+__all__ = list(_exports)
+
+
+def __getattr__(name):
+    module = _exports.get(name)
+    if module is None:
+        raise AttributeError(f"module 'exectree' has no attribute '{name}'")
+    return getattr(importlib.import_module(f"exectree.{module}"), name)
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
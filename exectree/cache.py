@@ -0,0 +1,170 @@
+'''
+Keeps the compiled plans of the configurations on disk, so that a controller restarting with
+the same configuration doesn't have to parse, check and derive the FSMs all over again
+
+The files are named after the sha256 of the configuration, and hold a marshal dump (no pickle)
+of the plan flattened in tuples. The header has the version of the file format, of the package and of
+python: if any of them changed, or if the file is broken in any way, the plan is compiled again.
+'''
+import gc
+import hashlib
+import json
+import marshal
+import os
+import sys
+import tempfile
+
+from . import __version__
+from . import plan as _plan
+from .plan import NodePlan
+
+MAGIC = b"EXTPLAN"
+FORMAT_VERSION = 2
+
+
+def default_cache_dir():
+    if os.environ.get("EXECTREE_CACHE_DIR"):
+        return os.environ["EXECTREE_CACHE_DIR"]
+    return os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "exectree")
+
+
+def config_hash(config_text):
+    if isinstance(config_text, str):
+        config_text = config_text.encode()
+    return hashlib.sha256(config_text).hexdigest()
+
+
+def _header():
+    return (FORMAT_VERSION, __version__, tuple(sys.version_info[:2]), marshal.version)
+
+
+def _flatten(top):
+    ## NodePlans -> nested tuples, the FSMs and configurations are stored once and referred to by index
+    fsms, fsm_index = [], {}
+    configs, config_index = [], {}
+
+    def index(obj, objs, indices):
+        i = indices.get(id(obj))
+        if i is None:
+            i = indices[id(obj)] = len(objs)
+            objs.append(obj)
+        return i
+
+    def flatten(node):
+        ## the leaves are only their name, they always have their parent's configuration and FSM,
+        ## a (template,) in between says what the leaves after it are, until the next one
+        children = []
+        template = None
+        for child in node.children:
+            if not child.leaf:
+                children.append(flatten(child))
+                continue
+            if child.template != template:
+                template = child.template
+                children.append((template,))
+            children.append(child.name)
+        return (
+            node.name,
+            index(node.config, configs, config_index),
+            index(node.fsm, fsms, fsm_index),
+            tuple(children),
+        )
+
+    root = flatten(top)
+    fsm_keys = [_plan.fsm_key(fsm) for fsm in fsms]
+    return (
+        tuple((key, tuple(fsm)) for key, fsm in zip(fsm_keys, fsms)),
+        tuple(dict(config) for config in configs),
+        root,
+    )
+
+
+def _unflatten(flat):
+    fsm_tuples, config_dicts, root = flat
+    fsms = []
+    for key, fsm_tuple in fsm_tuples:
+        # so that FSMConfig finds them, instead of deriving them again
+        fsms.append(_plan.register_fsm(key, _plan.FSMPlan(*fsm_tuple)))
+    configs = [_plan.MappingProxyType(config) for config in config_dicts]
+
+    new = tuple.__new__ # NodePlan(...) checks its arguments, that's a third of the time for big trees
+    empty = ()
+
+    def unflatten(node, path):
+        name, config, fsm, children = node
+        config, fsm = configs[config], fsms[fsm]
+        path = path+"/"+name if path else name
+        prefix = path+"/"
+        plans = []
+        template = None
+        for child in children:
+            if child.__class__ is str:
+                plans.append(new(NodePlan, (child, prefix+child, config, fsm, empty, True, template)))
+            elif len(child) == 1:
+                template = child[0]
+            else:
+                plans.append(unflatten(child, path))
+        return new(NodePlan, (name, path, config, fsm, tuple(plans), False, None))
+
+    return unflatten(root, "")
+
+
+def load_plan(config_text, cache_dir=None):
+    '''
+    The cached plan of this configuration, or None if there isn't a valid one
+    '''
+    path = os.path.join(cache_dir or default_cache_dir(), config_hash(config_text)+".plan")
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        if not data.startswith(MAGIC):
+            return None
+        header, digest, flat = marshal.loads(data[len(MAGIC):])
+        if header != _header() or digest != config_hash(config_text):
+            return None
+        ## Only tuples are created, no cycles for the gc to find, but it would still
+        ## go through them over and over as they pile up (that's half the time)
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return _unflatten(flat)
+        finally:
+            if gc_enabled:
+                gc.enable()
+    except Exception:
+        # missing, from another version, truncated... same story, it needs compiling
+        return None
+
+
+def store_plan(top, config_text, cache_dir=None):
+    '''
+    Writes the plan atomically, so that concurrent controllers never read half a file
+    '''
+    cache_dir = cache_dir or default_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    data = MAGIC + marshal.dumps((_header(), config_hash(config_text), _flatten(top)))
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(cache_dir, config_hash(config_text)+".plan"))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def compile_cached(config_text, cache_dir=None):
+    '''
+    The plan of the configuration, from the cache if it's there, otherwise compiled and cached
+    Failing to write the cache isn't fatal, the plan is still returned
+    '''
+    top = load_plan(config_text, cache_dir)
+    if top is not None:
+        return top
+
+    top = _plan.compile_config(json.loads(config_text))
+    try:
+        store_plan(top, config_text, cache_dir)
+    except OSError:
+        pass
+    return top
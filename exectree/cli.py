@@ -0,0 +1,236 @@
+'''
+Command line: loads a tree and runs commands on it, on the whole tree or on a selection of nodes
+
+  python -m exectree run top_config_simple.json --leaf-class main_simple:WIBBaseNode boot init "conf@np04_vst/wibs/wib[12]"
+
+Every step is a command, optionally followed by @ and a selection: a path glob, or
+path=...,state=...,tag=... (see multicast.py). Without selection the command goes to the top node.
+
+Or with a daemon holding the tree (see daemon.py):
+
+  python -m exectree serve top_config_simple.json --leaf-class main_simple:WIBBaseNode &
+  python -m exectree send boot
+  python -m exectree status "np04_vst/wibs/*"
+  python -m exectree errors "np04_vst/wibs/*"
+  python -m exectree watch
+
+And the diagrams of the state machines and of the tree (see graph.py):
+
+  python -m exectree graph top_config_simple.json --out diagrams --format svg
+'''
+import argparse
+import importlib
+import json
+import sys
+
+
+def parse_selector(text):
+    '''
+    "np04_vst/wibs/*" or "path=np04_vst/wibs/*,state=configured,tag=daq" -> {"path": ..., "state": ..., "tag": ...}
+    '''
+    selector = {}
+    for part in text.split(","):
+        key, sep, value = part.partition("=")
+        if not sep:
+            key, value = "path", part
+        if key not in ["path", "state", "tag"]:
+            raise ValueError(f"Can't understand \"{part}\" in \"{text}\", expected path=, state= or tag=")
+        selector[key] = value
+    return selector
+
+
+def parse_step(text):
+    command, _, selector = text.partition("@")
+    return command, parse_selector(selector) if selector else None
+
+
+def import_class(text):
+    ## "module:Class"
+    module, _, name = text.partition(":")
+    return getattr(importlib.import_module(module), name)
+
+
+def leaf_classes(texts):
+    '''
+    ["module:Class", "template=module:Class", ...] -> the class of all the leaves, or {template: class} (see simple.load)
+    '''
+    if not texts:
+        return None
+    classes = {}
+    for text in texts:
+        template, _, path = text.rpartition("=")
+        classes[template or None] = import_class(path)
+    if list(classes) == [None]:
+        return classes[None]
+    return classes
+
+
+def run(args, console):
+    from . import simple
+    from .plan import ConfigError
+
+    try:
+        steps = [parse_step(step) for step in args.steps]
+        leaf_class = leaf_classes(args.leaf_class)
+        tree = simple.loads(args.config, console, leaf_class=leaf_class)
+        tree.create_fsms()
+    except (ConfigError, ValueError) as e:
+        console.print(f"[red]{e}[/red]")
+        return 2
+
+    status = 0
+    try:
+        for command, selector in steps:
+            result = tree.multicast(command, timeout=args.timeout, **(selector or {"path": tree.name}))
+            console.print_json(json.dumps(result))
+            if result["failed"] or result["timeout"]:
+                status = 1
+                if not args.keep_going:
+                    break
+        tree.print_status(console)
+    finally:
+        tree.quit(timeout=args.timeout)
+    return status
+
+
+def serve(args, console):
+    from . import simple
+    from .daemon import Daemon
+    from .plan import ConfigError
+
+    try:
+        leaf_class = leaf_classes(args.leaf_class)
+        tree = simple.loads(args.config, console, leaf_class=leaf_class)
+        tree.create_fsms()
+    except (ConfigError, ValueError) as e:
+        console.print(f"[red]{e}[/red]")
+        return 2
+    try:
+        Daemon(tree, args.socket).serve_forever()
+    finally:
+        tree.quit()
+    return 0
+
+
+def graph(args, console):
+    from . import simple
+    from .plan import ConfigError
+
+    try:
+        tree = simple.loads(args.config, console)
+        # nothing runs, the leaves don't need their user code
+        tree._create_fsm()
+    except (ConfigError, ValueError) as e:
+        console.print(f"[red]{e}[/red]")
+        return 2
+    try:
+        for path in tree.export_graphs(args.out, args.format):
+            console.print(path)
+    except RuntimeError as e:
+        console.print(f"[red]{e}[/red]")
+        return 2
+    finally:
+        tree.quit()
+    return 0
+
+
+def client(args):
+    ## Thin client of the daemon: plain printing, no rich to import for a one line answer
+    from .daemon import Client
+
+    try:
+        connection = Client(args.socket)
+    except (FileNotFoundError, ConnectionRefusedError):
+        print(f"No daemon listening on {args.socket or 'the default socket'}, start one with \"exectree serve\"", file=sys.stderr)
+        return 2
+
+    try:
+        if args.action == "send":
+            command, selector = parse_step(args.step)
+            result = connection.request(op="send", command=command, wait=not args.no_wait,
+                                        timeout=args.timeout, **(selector or {}))
+            print(json.dumps(result, indent=2))
+            return 1 if result.get("error") or result.get("failed") or result.get("timeout") else 0
+
+        if args.action == "wait":
+            result = connection.request(op="wait", id=args.id, timeout=args.timeout)
+            print(json.dumps(result, indent=2))
+            return 1 if result.get("error") or result.get("failed") or result.get("timeout") else 0
+
+        selector = parse_selector(args.selection) if args.selection else {}
+        if args.action == "status":
+            for node in connection.request(op="status", **selector)["nodes"]:
+                print(f"{node['path']:<60} {node['state']}")
+            return 0
+
+        if args.action == "errors":
+            errors = connection.request(op="errors", **selector)["errors"]
+            print(json.dumps(errors, indent=2))
+            return 0
+
+        # watch
+        try:
+            for message in connection.watch(**selector):
+                for node in message.get("nodes", [message]):
+                    print(f"{node['path']:<60} {node['state']}", flush=True)
+        except KeyboardInterrupt:
+            pass
+        return 0
+    finally:
+        connection.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="exectree", description="Drive a tree of FSMs")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+
+    run_parser = subparsers.add_parser("run", help="load a tree and send it commands")
+    run_parser.add_argument("config", help="json configuration of the tree")
+    run_parser.add_argument("steps", nargs="+", help="command[@selection], ex: conf@np04_vst/wibs/wib[12]")
+    run_parser.add_argument("--leaf-class", action="append",
+                            help="module:Class of the leaves, ExecLeaf by default, or template=module:Class (repeatable)")
+    run_parser.add_argument("--timeout", type=float, default=15., help="seconds to wait for each command")
+    run_parser.add_argument("--keep-going", action="store_true", help="carry on with the next commands after a failure")
+
+    serve_parser = subparsers.add_parser("serve", help="load a tree and serve it on a unix socket")
+    serve_parser.add_argument("config", help="json configuration of the tree")
+    serve_parser.add_argument("--leaf-class", action="append",
+                              help="module:Class of the leaves, ExecLeaf by default, or template=module:Class (repeatable)")
+
+    graph_parser = subparsers.add_parser("graph", help="write the diagrams of the state machines and of the tree")
+    graph_parser.add_argument("config", help="json configuration of the tree")
+    graph_parser.add_argument("--out", default=".", help="directory to write them in")
+    graph_parser.add_argument("--format", choices=["dot", "svg"], default="dot", help="svg needs graphviz")
+
+    send_parser = subparsers.add_parser("send", help="send a command to the tree served by the daemon")
+    send_parser.add_argument("step", help="command[@selection], ex: conf@np04_vst/wibs/wib[12]")
+    send_parser.add_argument("--timeout", type=float, default=15., help="seconds to wait for the command")
+    send_parser.add_argument("--no-wait", action="store_true", help="print the id of the command and return straight away")
+
+    wait_parser = subparsers.add_parser("wait", help="wait for a command sent with --no-wait")
+    wait_parser.add_argument("id", type=int)
+    wait_parser.add_argument("--timeout", type=float, default=None)
+
+    for action, what in [("status", "print the states"), ("watch", "print the states, then every change"),
+                         ("errors", "print the last error of each node, in full")]:
+        action_parser = subparsers.add_parser(action, help=what+" of the tree served by the daemon")
+        action_parser.add_argument("selection", nargs="?", help="path glob or path=...,state=...,tag=...")
+
+    for action_parser in [serve_parser, send_parser, wait_parser] + [subparsers.choices[action] for action in ["status", "watch", "errors"]]:
+        action_parser.add_argument("--socket", help="unix socket of the daemon, $XDG_RUNTIME_DIR/exectree.sock by default")
+
+    args = parser.parse_args(argv)
+    if args.action not in ["run", "serve", "graph"]:
+        return client(args)
+
+    from rich.console import Console
+    console = Console()
+    if args.action == "run":
+        return run(args, console)
+    if args.action == "serve":
+        return serve(args, console)
+    return graph(args, console)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
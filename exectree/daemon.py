@@ -0,0 +1,254 @@
+'''
+A process holding a loaded tree, driven through a local unix socket
+
+The protocol is one json object per line, both ways. Requests have an "op":
+  {"op": "send", "command": "conf", "path": "np04_vst/wibs/*", "state": ..., "tag": ..., "wait": true, "timeout": 15}
+      -> the multicast summary (see multicast.py) and "elapsed", or {"id": 3} if "wait" is false
+  {"op": "wait", "id": 3, "timeout": 15} -> the summary of that send, once it's finished
+  {"op": "status", "path": ..., "state": ..., "tag": ...} -> {"nodes": [{"path": ..., "state": ...}, ...]}
+  {"op": "errors", "path": ..., "state": ..., "tag": ...} -> {"errors": {path: the message it last went on error with}}
+  {"op": "watch", "path": ..., "state": ..., "tag": ...} -> the status, then one {"path": ..., "state": ...} line
+      per change of state of a node matching them, until the client leaves
+Errors come back as {"error": "..."}.
+The changes of state come from one subscription to the event bus (see events.py), each of them is
+encoded once and goes to the watchers whose path, state and tag it matches; a watcher that doesn't
+keep up loses its oldest changes.
+'''
+import fnmatch
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from collections import deque
+
+from . import events
+from .multicast import select, _state_matches
+
+
+def default_socket_path():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "exectree.sock")
+    return f"/tmp/exectree-{os.getuid()}.sock"
+
+
+class _Watcher():
+    ## The lines waiting to be sent to one client, for the changes matching its selection
+    def __init__(self, max_lines, path=None, state=None, tag=None):
+        self.lines = deque(maxlen=max_lines)
+        self.ready = threading.Condition()
+        self.path = path
+        self.state = state
+        self.tag = tag
+
+    def wants(self, change):
+        if self.path is not None and not fnmatch.fnmatchcase(change.path, self.path):
+            return False
+        if self.tag is not None and self.tag not in change.node.fsm_config.tags:
+            return False
+        return _state_matches(change.state, self.state)
+
+    def put(self, lines):
+        with self.ready:
+            self.lines.extend(lines)
+            self.ready.notify()
+
+    def get(self, timeout):
+        with self.ready:
+            if not self.lines:
+                self.ready.wait(timeout)
+            lines = list(self.lines)
+            self.lines.clear()
+        return lines
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        daemon = self.server.owner
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if request.get("op") == "watch":
+                    # the connection is the watcher's until it goes away
+                    daemon.op_watch(request, self.wfile)
+                    return
+                op = {"send": daemon.op_send, "wait": daemon.op_wait, "status": daemon.op_status,
+                      "errors": daemon.op_errors}.get(request.get("op"))
+                if op is None:
+                    raise ValueError(f"unknown op \"{request.get('op')}\", expected send, wait, status, errors or watch")
+                response = op(request)
+            except (ValueError, KeyError, TypeError) as e:
+                response = {"error": str(e)}
+            self.wfile.write(json.dumps(response).encode()+b"\n")
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon():
+    '''
+    Serves the tree on a unix socket, until stop() (or Ctrl-C in serve_forever)
+    '''
+    def __init__(self, tree, socket_path=None, max_watch_lines=10000, max_jobs=1000):
+        self.tree = tree
+        self.socket_path = socket_path or default_socket_path()
+        self.max_watch_lines = max_watch_lines
+        self.max_jobs = max_jobs
+        self.jobs = {} # id -> [Event, summary]
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.watchers = []
+        self.server = None
+        self.subscription = None
+
+
+    def _state_changed(self, changes):
+        ## On the event bus' thread
+        if not self.watchers:
+            return
+        lines = [
+            (change, json.dumps({"path": change.path, "state": change.state, "time": change.time}).encode()+b"\n")
+            for change in changes
+        ]
+        for watcher in list(self.watchers):
+            wanted = [line for change, line in lines if watcher.wants(change)]
+            if wanted:
+                watcher.put(wanted)
+
+
+    def _status(self, request):
+        return [{"path": path, "state": node.state}
+                for path, node in select(self.tree, request.get("path"), request.get("state"), request.get("tag"))]
+
+
+    def op_status(self, request):
+        return {"nodes": self._status(request)}
+
+
+    def op_errors(self, request):
+        return {"errors": self.tree.error_details(request.get("path"), request.get("state"), request.get("tag"))}
+
+
+    def op_send(self, request):
+        command = request["command"]
+        timeout = float(request.get("timeout", 15.))
+        with self.lock:
+            job_id = self.next_id
+            self.next_id += 1
+            self.jobs[job_id] = job = [threading.Event(), None]
+            while len(self.jobs) > self.max_jobs:
+                del self.jobs[next(iter(self.jobs))]
+
+        def run():
+            start = time.monotonic()
+            try:
+                summary = self.tree.multicast(command, request.get("path", self.tree.name),
+                                              request.get("state"), request.get("tag"), timeout)
+            except Exception as e:
+                summary = {"command": command, "error": f"{type(e).__name__}: {e}"}
+            summary["elapsed"] = time.monotonic() - start
+            summary["id"] = job_id
+            job[1] = summary
+            job[0].set()
+
+        threading.Thread(target=run, name=f"exectree_send_{job_id}", daemon=True).start()
+        if request.get("wait", True):
+            job[0].wait()
+            return job[1]
+        return {"id": job_id}
+
+
+    def op_wait(self, request):
+        job = self.jobs.get(request["id"])
+        if job is None:
+            raise KeyError(f"no send with id {request['id']} (or a long time ago)")
+        if not job[0].wait(request.get("timeout")):
+            return {"id": request["id"], "error": "still running"}
+        return job[1]
+
+
+    def op_watch(self, request, wfile):
+        watcher = _Watcher(self.max_watch_lines, request.get("path"), request.get("state"), request.get("tag"))
+        self.watchers.append(watcher)
+        try:
+            wfile.write(json.dumps({"nodes": self._status(request)}).encode()+b"\n")
+            wfile.flush()
+            while self.server is not None:
+                lines = watcher.get(timeout=1.)
+                if lines:
+                    wfile.write(b"".join(lines))
+                    wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.watchers.remove(watcher)
+
+
+    def start(self):
+        ## Serves on a thread of its own, returns straight away
+        if os.path.exists(self.socket_path):
+            # a socket left over by a daemon that died, unless someone still answers on it
+            try:
+                with socket.socket(socket.AF_UNIX) as s:
+                    s.connect(self.socket_path)
+                raise RuntimeError(f"A daemon is already listening on {self.socket_path}")
+            except ConnectionRefusedError:
+                os.unlink(self.socket_path)
+        self.server = _Server(self.socket_path, _Handler)
+        self.server.owner = self
+        self.subscription = events.subscribe(subtree=self.tree, callback=self._state_changed, max_pending=self.max_watch_lines)
+        threading.Thread(target=self.server.serve_forever, name="exectree_daemon", daemon=True).start()
+        self.tree.console.log(f"Serving {self.tree.name} on {self.socket_path}")
+
+
+    def stop(self):
+        server, self.server = self.server, None
+        if server is None:
+            return
+        self.subscription.close()
+        server.shutdown()
+        server.server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+    def serve_forever(self):
+        self.start()
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+
+class Client():
+    '''
+    The other end of the socket, one request at a time
+    '''
+    def __init__(self, socket_path=None, timeout=None):
+        self.socket = socket.socket(socket.AF_UNIX)
+        self.socket.settimeout(timeout)
+        self.socket.connect(socket_path or default_socket_path())
+        self.file = self.socket.makefile("rwb")
+
+    def request(self, **request):
+        self.file.write(json.dumps(request).encode()+b"\n")
+        self.file.flush()
+        return json.loads(self.file.readline())
+
+    def watch(self, **request):
+        ## Yields the status, then every change of state
+        self.file.write(json.dumps({"op": "watch", **request}).encode()+b"\n")
+        self.file.flush()
+        for line in self.file:
+            yield json.loads(line)
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
@@ -0,0 +1,193 @@
+'''
+Subscriptions to the changes of state of the nodes, so that nobody needs to walk the tree to follow it
+
+  subscription = events.subscribe(subtree="np04_vst/wibs", states=["error"])
+  for change in subscription.get(timeout=1.): ...          # a queue, in batches
+  events.subscribe(callback=print_batch)                   # a callback, on the bus' own thread
+  async for batch in events.subscribe(): ...               # an async iterator
+
+The node publishing a change only appends it to the matching subscriptions: a subscriber that doesn't
+keep up loses its oldest changes (counted in subscription.dropped), it never slows down the transitions.
+Nothing is published while there's no subscription.
+'''
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import NamedTuple
+
+from .simple import _state_listeners
+
+
+class StateChange(NamedTuple):
+    time: float
+    path: str # "np04_vst/wibs/wib1"
+    state: str
+    source: str # the state it left, None if it was set without a transition
+    node: object
+
+
+def _node_path(node):
+    return "/".join(n.name for n in node.path)
+
+
+class Subscription():
+    '''
+    The changes matching the filters, waiting to be consumed
+    subtree is a path ("np04_vst/wibs"), or a node, states a list of states
+    '''
+    def __init__(self, bus, subtree=None, states=None, callback=None, max_pending=10000, max_batch=1000):
+        if subtree is not None and not isinstance(subtree, str):
+            subtree = _node_path(subtree)
+        self.bus = bus
+        self.subtree = subtree
+        self.states = frozenset(states) if states is not None else None
+        self.callback = callback
+        self.max_batch = max_batch
+        self.pending = deque(maxlen=max_pending)
+        self.dropped = 0
+        self.closed = False
+        self.ready = threading.Condition()
+        self._waker = None # (loop, future) of an async iterator waiting for changes
+
+
+    def matches(self, path, state):
+        if self.states is not None and state not in self.states:
+            return False
+        if self.subtree is None:
+            return True
+        return path == self.subtree or path.startswith(self.subtree+"/")
+
+
+    def put(self, change):
+        with self.ready:
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped += 1 # the deque drops the oldest one
+            self.pending.append(change)
+            self.ready.notify()
+            waker, self._waker = self._waker, None
+        if waker is not None:
+            loop, future = waker
+            loop.call_soon_threadsafe(_wake, future)
+
+
+    def get(self, timeout=None):
+        '''
+        The next batch of changes (a list, at most max_batch of them), empty if there was none within timeout
+        '''
+        with self.ready:
+            if not self.pending and not self.closed and timeout != 0:
+                self.ready.wait(timeout)
+            n = min(len(self.pending), self.max_batch)
+            return [self.pending.popleft() for _ in range(n)]
+
+
+    def close(self):
+        self.bus.unsubscribe(self)
+        with self.ready:
+            self.closed = True
+            self.ready.notify_all()
+            waker, self._waker = self._waker, None
+        if waker is not None:
+            waker[0].call_soon_threadsafe(_wake, waker[1])
+
+
+    def __aiter__(self):
+        return self
+
+
+    async def __anext__(self):
+        while True:
+            batch = self.get(timeout=0)
+            if batch:
+                return batch
+            if self.closed:
+                raise StopAsyncIteration
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            with self.ready:
+                if self.pending or self.closed:
+                    continue
+                self._waker = (loop, future)
+            await future
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class EventBus():
+    '''
+    Hands the changes of state over to the subscriptions
+    The callbacks are all called from one thread, started with the first of them
+    '''
+    def __init__(self, interval=0.):
+        self.interval = interval # the callbacks get at most a batch every interval seconds
+        self.subscriptions = []
+        self.lock = threading.Lock()
+        self.dispatcher = None
+        self.wakeup = threading.Event()
+
+
+    def subscribe(self, subtree=None, states=None, callback=None, max_pending=10000, max_batch=1000):
+        subscription = Subscription(self, subtree, states, callback, max_pending, max_batch)
+        with self.lock:
+            if not self.subscriptions:
+                _state_listeners.append(self.publish)
+            # copied, so that publish never needs the lock
+            self.subscriptions = self.subscriptions + [subscription]
+            if callback is not None and self.dispatcher is None:
+                self.dispatcher = threading.Thread(target=self._dispatch, name="exectree_events", daemon=True)
+                self.dispatcher.start()
+        return subscription
+
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            if subscription not in self.subscriptions:
+                return
+            self.subscriptions = [s for s in self.subscriptions if s is not subscription]
+            if not self.subscriptions:
+                _state_listeners.remove(self.publish)
+
+
+    def publish(self, node, source=None):
+        ## On the thread of the node that changed
+        subscriptions = self.subscriptions
+        if not subscriptions:
+            return
+        path = _node_path(node)
+        state = node.state
+        change = None
+        for subscription in subscriptions:
+            if subscription.matches(path, state):
+                if change is None:
+                    change = StateChange(time.time(), path, state, source, node)
+                subscription.put(change)
+                if subscription.callback is not None:
+                    self.wakeup.set()
+
+
+    def _dispatch(self):
+        while True:
+            self.wakeup.wait()
+            if self.interval:
+                time.sleep(self.interval)
+            self.wakeup.clear()
+            for subscription in self.subscriptions:
+                if subscription.callback is None:
+                    continue
+                batch = subscription.get(timeout=0)
+                while batch:
+                    try:
+                        subscription.callback(batch)
+                    except Exception as e:
+                        node = batch[0].node
+                        node.console.log(f"Subscriber {subscription.callback} failed on {len(batch)} change(s): {e}")
+                    batch = subscription.get(timeout=0)
+
+
+# the one the nodes publish to
+bus = EventBus()
+subscribe = bus.subscribe
@@ -1,20 +1,16 @@
-from anytree import NodeMixin, RenderTree
+from anytree import NodeMixin, RenderTree, PreOrderIter
 import json
 import copy
 from transitions import Machine
-from transitions.extensions import GraphMachine
 import inspect
-from rich.segment import Segment
-from rich.console import Console
-from rich.table import Table
-import os
-import signal
 import threading
-from queue import Queue
-import threading as th
 import time
 
-    
+from .sender import CommandSender, shutdown
+from .plan import ConfigError, validate
+
+ACK_TIMEOUT = 3. # seconds for a child to acknowledge a short command before it's reported as late
+
 class FSMConfig():
     '''
     A class that holds all the FSM configuration stored on each node
@@ -36,45 +32,12 @@ class FSMConfig():
         self.state_conf = config_json.get("state-conf")
 
 
-class CommandSender(threading.Thread):
-    '''
-    A class to send command to the node
-    '''
-    STOP="RESPONSE_QUEUE_STOP"
-
-    def __init__(self, node):
-        threading.Thread.__init__(self, name=f"command_sender_{node.name}")
-        self.node = node
-        self.queue = Queue()
-
-
-    def add_command(self, cmd):
-        self.queue.put(cmd)
-
-
-    def run(self):
-        while True:
-            command = self.queue.get()
-            if command == self.STOP:
-                break
-            if command:
-                cmd = getattr(self.node, command, None)
-                if not cmd:
-                    raise RuntimeError(f"ERROR: {self.node.name}: I don't know of '{command}'")
-                self.node.console.log(f"{self.node.name} Ack: executing '{command}'")
-                cmd()
-                self.node.console.log(f"{self.node.name} Finished '{command}'")
-
-
-    def stop(self):
-        self.queue.put_nowait(self.STOP)
-        self.join()
-
-    
 class ExecNode(NodeMixin):
     '''
     A node that is just sending commands to its children nodes
     '''
+    _command_sender_lock = threading.Lock()
+
     def __init__(self, name:str,
                  fsm_config=None, parent=None, children=None, console=None):
         self.console = console
@@ -83,19 +46,45 @@ class ExecNode(NodeMixin):
         if children:
             self.children = children
         self.last_successful_cmd = None
-        self.command_sender = CommandSender(self)
-        self.command_sender.start()
+        # The thread is only created when the node receives its first command
+        self._command_sender = None
         self.fsm_config = FSMConfig(fsm_config)
+        # child -> [command, sent, acknowledged, error] of the last short command sent to the children
+        self.acks = {}
+        self.acks_changed = threading.Condition()
+
+
+    @property
+    def command_sender(self):
+        if self._command_sender is None:
+            with self._command_sender_lock:
+                if self._command_sender is None:
+                    command_sender = CommandSender(self)
+                    command_sender.start()
+                    self._command_sender = command_sender
+        return self._command_sender
 
 
     def create_fsms(self):
         ## Annoyingly, this needs to be called _after_ the callbacks on_enter_blabla have been registered,
         ## so it can't go in the ctor
+        self._create_fsm()
+        # Now that every node has its callbacks, check that the children can handle whatever their parent sends them
+        missing = _missing_callbacks(self)
+        if missing:
+            raise ConfigError(missing)
+
+
+    def _create_fsm(self):
         self.fsm = FSMFactory(self, self.fsm_config)
+        # where each command takes this node, for the parent's short transitions
+        self.destinations = {}
+        for transition in self.fsm_config.transitions:
+            self.destinations.setdefault(transition["trigger"], transition["dest"])
 
         if self.children:
             for child in self.children:
-                child.create_fsms()
+                child._create_fsm()
 
 
     def _set_environment(self, event):
@@ -104,95 +93,97 @@ class ExecNode(NodeMixin):
         self.event = event
 
 
-    def quit(self):
+    def quit(self, timeout=5.):
         ## Somehow I can't move this to the __del__?
         ## I don't know how to delete an anytree properly
+        ## Returns the nodes that didn't stop within the timeout
         self.console.log(f"Killing me softly... {self.name}")
-        self.command_sender.stop()
-        for child in self.children:
-            child.quit()
+        return shutdown(self, timeout)
 
 
     def notify_on_success(self, command):
         ## This one is for the quick commands
         ## TODO merge the 2 methods: _notify_on_success is for the long transitions
         self.last_successful_cmd = command
+        if self.parent is not None:
+            self.parent._acknowledge(self, command)
+
+
+    def _transition_failed(self, event):
+        ## on_exception of the machine: the parent won't get its acknowledgement, then same as without it
+        if self.parent is not None:
+            self.parent._acknowledge(self, event.event.name, f"{type(event.error).__name__}: {event.error}")
+        raise event.error
+
+
+    def _acknowledge(self, child, command, error=None):
+        ## On the child's thread: it's done with (or failed) the short command this node sent it
+        now = time.monotonic()
+        with self.acks_changed:
+            ack = self.acks.get(child)
+            if ack is None or ack[0] != command or ack[2] is not None:
+                # not one this node is waiting for (a long transition, or the child was sent something newer)
+                return
+            ack[2] = now
+            ack[3] = error
+            self.acks_changed.notify_all()
+        if error is not None:
+            self.console.log(f"Shit hit the fan... {child.name} failed '{command}' after {self.name} moved on: {error}")
+        elif now-ack[1] > ACK_TIMEOUT:
+            self.console.log(f"{child.name} acknowledged '{command}' late, after {now-ack[1]:.1f}s")
+
+
+    def _pending(self):
+        return [child for child, ack in self.acks.items() if ack[2] is None]
+
+
+    def wait_acks(self, timeout=ACK_TIMEOUT):
+        '''
+        For whoever wants to know that the short command went all the way down: waits until every node below this one
+        has the acknowledgements of its children, or timeout. Returns whether they all came
+        '''
+        deadline = time.monotonic() + timeout
+        for node in PreOrderIter(self):
+            with node.acks_changed:
+                if not node.acks_changed.wait_for(lambda: not node._pending(), max(0., deadline-time.monotonic())):
+                    return False
+        return True
 
 
-    def print_fsm(self, console:Console=None):
-        ## Some helper function on the FSM, to printout what we are allowed to do
-
-        # If we are in between states, bail
-        if len(self.state)>4 and self.state[-4:] == "-ing":
-            self.console.print(f"Can't send command, node is {self.state}")
-            return
-        
-        table = Table(title=f"{self.name} commands")
-        table.add_column("Previous",justify='left')
-        table.add_column("Current",justify='center')
-        table.add_column("Next",justify='left')
-        transitions_in = []
-        transitions_out = []
-        now_state = self.state
-        for transition in self.fsm_config.transitions:
-            if transition['dest']   == now_state:
-                transitions_in .append(transition)
-            if transition['source'] == now_state:
-                transitions_out.append(transition)
-
-        n_t_in, n_t_out = len(transitions_in), len(transitions_out)
-        n_lines = max(n_t_in, n_t_out)
-
-        for i in range(n_lines):
-            text = []
-            if i<n_t_in:
-                if self.last_successful_cmd and len(self.last_successful_cmd)>4 and self.last_successful_cmd[:4]=="end_":
-                    last=self.last_successful_cmd[4:]
+    def reconcile(self, timeout=ACK_TIMEOUT):
+        '''
+        Where the tree below this node isn't where its short commands should have taken it: the children that failed
+        the last one they were sent, or that haven't acknowledged it after timeout seconds
+        Returns {node name: {child name: (command, what happened, state of the child)}}
+        '''
+        now = time.monotonic()
+        wrong = {}
+        for node in PreOrderIter(self):
+            with node.acks_changed:
+                acks = [(child, list(ack)) for child, ack in node.acks.items()]
+            for child, (command, sent, acknowledged, error) in acks:
+                if error is not None:
+                    what = f"failed: {error}"
+                elif acknowledged is None and now-sent > timeout:
+                    what = f"not acknowledged after {now-sent:.1f}s"
                 else:
-                    last=self.last_successful_cmd
-
-                # Highlights the last command that was executed
-                if transitions_in[i]["trigger"] == last:
-                    ### Any way to make a better arrow?
-                    text += ["[blue]"+transitions_in[i]["source"]+"[/blue]──[[green]"+transitions_in[i]["trigger"]+"[/green]]──>" ]
-                else:
-                    text += ["[blue]"+transitions_in[i]["source"]+"[/blue]──\["+transitions_in[i]["trigger"]+"]──>" ]
-            else: 
-                text += ["", ""]
+                    continue
+                wrong.setdefault(node.name, {})[child.name] = (command, what, child.state)
+        if wrong:
+            self.console.log(f"Shit hit the fan... below {self.name}: {wrong}")
+        return wrong
 
-            if i+1==int((n_lines+1)/2):
-                text += ["[magenta]"+now_state+"[/magenta]"]
-            else:
-                text += [""]
 
-            if i<n_t_out:
-                text += ["──\["+transitions_out[i]["trigger"]+"]──>[blue]"+transitions_out[i]["dest"]+"[/blue]"]
-            else: 
-                text += ["", ""]
-            table.add_row(*text)
-        console.print(table)
+    def print_fsm(self, console=None):
+        ## Some helper function on the FSM, to printout what we are allowed to do
+        from . import render
+        render.print_fsm(self, console, ing_suffix="-ing")
 
 
-    def print_status(self, console:Console=None):
+    def print_status(self, console=None):
         ## Usual status
-        table = Table(title=f"apps")
-        table.add_column("name", style="blue")
-        table.add_column("state", style="magenta")
-        table.add_column("consistent")
-        table.add_column("included", style="magenta")
-
-        for pre, _, node in RenderTree(self):
-            state = node.state if node.state[-3:] != "ing" else "[yellow]"+node.state+"[/yellow]"
-            error = "yes" if node.is_consistent() else "[red]no[/red]"
-            included = "yes" if node.fsm_config.included else "no"
-            table.add_row(
-                pre+node.name,
-                state,
-                error,
-                included
-            )
-
-        console.print(table)
+        from . import render
+        render.print_consistency(self, console)
 
     def is_consistent(self):
         ## Fills the consistent flag (are my children in the same state as me?)
@@ -244,6 +235,47 @@ def _construct_tree(config:dict, mother, console):
             raise RuntimeError(f"ERROR processing the tree {child_name}: {value} I don't know what that's supposed to mean?")
 
 
+def _missing_callbacks(topnode):
+    ## For all the commands a node can forward, the callbacks its children are missing
+    missing = []
+    for node in PreOrderIter(topnode):
+        if not node.children:
+            continue
+        # every short trigger has to be forwarded, whatever else goes to the same state
+        for trigger, event in node.fsm.events.items():
+            if trigger.startswith("end_"):
+                continue
+            for transitions in event.transitions.values():
+                for transition in transitions:
+                    if transition.dest.endswith("-ing"):
+                        continue
+                    callback = getattr(getattr(node, "on_enter_"+transition.dest, None), "__func__", None)
+                    if callback is not _transition_no_interm:
+                        missing.append(f"{node.name} doesn't forward the short '{trigger}' to its children (on_enter_{transition.dest})")
+        for state in node.fsm.states:
+            callback = getattr(getattr(node, "on_enter_"+state, None), "__func__", None)
+            if callback is _transition_with_interm:
+                # The children go through the same state
+                for child in node.children:
+                    if not inspect.ismethod(getattr(child, "on_enter_"+state, None)):
+                        missing.append(f"{child.name} doesn't have on_enter_{state} registered")
+            elif callback is _transition_no_interm:
+                triggers = {
+                    trigger
+                    for trigger, event in node.fsm.events.items()
+                    for transitions in event.transitions.values()
+                    for transition in transitions if transition.dest == state and not trigger.startswith("end_")
+                }
+                for trigger in triggers:
+                    for child in node.children:
+                        dest = child.destinations.get(trigger)
+                        if dest is None:
+                            missing.append(f"No transition found for {trigger} on {child.name}")
+                        elif not inspect.ismethod(getattr(child, "on_enter_"+dest, None)):
+                            missing.append(f"{child.name} doesn't have on_enter_{dest} registered")
+    return list(dict.fromkeys(missing)) # without the duplicates, but in order
+
+
 def load(config:dict, console):
     '''
     Load json string to the full blown tree+fsms
@@ -251,10 +283,8 @@ def load(config:dict, console):
     
     config = json.loads(config)
 
-    top = list(config.keys())
-    if len(top)!= 1:
-        raise RuntimeError("JSon should have exactly 1 key")
-    top=top[0]
+    # Reports all the mistakes in the configuration at once (see plan.py)
+    top = validate(config)
 
     fsm_config = copy.deepcopy(config[top])
     
@@ -299,13 +329,7 @@ def _transition_with_interm(cls, _):
     still_to_exec = []
     for child in cls.children:
         cls.console.log(f"{cls.name} is sending '{trigger}' to {child.name}")
-        # Just a quick check that the user has defined the callback, similar to the one in pytransition
-        # Otherwise, the transitions never timeout
-        mname = "on_enter_"+trigger+"-ing"
-        if not hasattr(child, mname):
-            raise RuntimeError(f"{child.name} doesn't have {mname} registered")
-        if not inspect.ismethod(getattr(child, mname)):
-            raise RuntimeError(f"{child.name} doesn't have {mname} registered")
+        # create_fsms checked that the child has on_enter_<trigger>-ing
 
         ## TODO add order here!!
         still_to_exec.append(child) # a record of which children still need to finish their task
@@ -320,7 +344,9 @@ def _transition_with_interm(cls, _):
                 
         if len(still_to_exec) == 0: # if all done, continue
             break 
-        time.sleep(1)
+        if cls.command_sender.stopping.wait(1):
+            # The tree is being shut down
+            return
 
     if len(still_to_exec) > 0:
         cls.console.log(f"Shit hit the fan... {cls.name} can't {trigger} {[child.name for child in still_to_exec]}")
@@ -332,50 +358,36 @@ def _transition_with_interm(cls, _):
 
     
 def _transition_no_interm(cls, _):
+    '''
+    Short transitions are fire and forget: the node sends the command to its children and is done, the
+    children acknowledge on their own threads whenever they are (see _acknowledge, wait_acks and reconcile)
+    '''
     trigger = cls.event.event.name # command name
 
+    if trigger.startswith("end_"):
+        # the end of a long transition that goes to the same state, the children are already there
+        return
+
     if not cls.children: # "that should never happen"
         raise RuntimeError(f"{cls.name} doesn't have children to send commands to")
 
-    still_to_exec = []
+    now = time.monotonic()
+    with cls.acks_changed:
+        pending = cls._pending()
+        # before sending anything, so that no acknowledgement comes before its record
+        cls.acks = {child: [trigger, now, None, None] for child in cls.children}
+        cls.acks_changed.notify_all()
+    if pending:
+        cls.console.log(f"Shit hit the fan... {cls.name} sends '{trigger}' but {[child.name for child in pending]} never acknowledged the previous command")
+
     for child in cls.children:
         cls.console.log(f"{cls.name} is sending '{trigger}' to {child.name}")
-        ## Pfffff to get the callback name, we need to get the transition's destination...
-        ## Probably better way to do that
-        dest=""
-        for t in child.fsm_config.transitions:
-            if t["trigger"] == trigger:
-                dest = t["dest"]
-                break
-        if dest == "":
-            raise RuntimeError(f"No transition found for {trigger} on {child.name}")
-        mname = "on_enter_"+dest
-        # Just a quick check that the user has defined the callback, similar to the one in pytransition
-        # Otherwise, the transitions never timeout
-        if not hasattr(child, mname):
-            raise RuntimeError(f"{child.name} doesn't have {mname} registered")
-        if not inspect.ismethod(getattr(child, mname)):
-            raise RuntimeError(f"{child.name} doesn't have {mname} registered")
+        # create_fsms checked that the child has a transition for trigger, with its on_enter_<dest>
 
         ## TODO add order here!!
-        still_to_exec.append(child) # a record of which children still need to finish their task
         child.send_command(trigger) # send the commands
-        
-    timeout=30  ## TODO: specify timeout in cfg
-    for _ in range(timeout):
-        for child in cls.children:
-            if child in still_to_exec and child.last_successful_cmd == trigger:
-                still_to_exec.remove(child) # Bin this child that is done
 
-        if len(still_to_exec) == 0:
-            break
-        time.sleep(0.1) # TODO different from the _transition_with_interm which is a confusing
-
-    if len(still_to_exec) > 0:
-        cls.console.log(f"Shit hit the fan... {cls.name} can't {trigger} {[child.name for child in still_to_exec]}")
-        return
-
-    ## Direclty notify
+    ## Direclty notify, the node has already moved to its new state
     cls.notify_on_success(trigger)
 
 def _notify_on_success(cls, _):
@@ -462,6 +474,9 @@ def FSMFactory(model, config=None):
                 long_transitions = "long" in parent_transition_conf
 
             for transition in parent_transitions:
+                if transition.get("conf") == "short":
+                    continue
+
                 name = transition["trigger"]+"-ing"
                 # ... more of the same
                 if long_transitions or transition.get("conf") == "long":
@@ -490,6 +505,12 @@ def FSMFactory(model, config=None):
     else:
         my_states += transition_state_to_add
 
+    # where the short transitions go: a state can also be the end of a long one (stop and conf both
+    # go to configured), the node still has to forward the short trigger when it gets there
+    direct_transitions = config.transitions if config.transitions else model.parent.fsm_config.transitions
+    states_after_short_transition = [transition["dest"] for transition in direct_transitions
+                                     if transition not in long_transition_to_remove]
+
     for state in my_states:
         # incredibly ugly code that is meant to:
         if not isinstance(model, ExecLeaf):
@@ -498,7 +519,7 @@ def FSMFactory(model, config=None):
                 function_name = 'on_enter_'+state
                 print(f"{function_name} now in {model.name}")
                 setattr(model, function_name, _transition_with_interm.__get__(model))
-            elif not state in states_after_long_transition:
+            elif state in states_after_short_transition or not state in states_after_long_transition:
                 # ... depending if it's long or short
                 function_name = 'on_enter_'+state
                 print(f"{function_name} now in {model.name}")
@@ -514,7 +535,8 @@ def FSMFactory(model, config=None):
         config.initial = my_initial
 
     # Finally the macchinetta, after that model (i.e. the node) becomes an FSM (with only states)
-    machine = Machine(model=model, states=my_states, initial=my_initial, auto_transitions=False, send_event=True)
+    machine = Machine(model=model, states=my_states, initial=my_initial, auto_transitions=False, send_event=True,
+                      on_exception="_transition_failed")
 
     ## now we can add our transitions
     transition_to_include = []
@@ -0,0 +1,127 @@
+'''
+Diagrams of the state machines and of the tree, in graphviz DOT (or SVG if graphviz is installed)
+
+There is one diagram per distinct FSM, drawn from its FSMPlan (see plan.py), not per node:
+nodes with the same configuration share it. The tree diagram has one box per node with children,
+listing how many of its leaves are in each state, so it stays readable with 10k applications.
+'''
+import os
+import shutil
+import subprocess
+
+from anytree import PreOrderIter
+
+
+def _quote(text):
+    return '"' + str(text).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def fsm_dot(fsm, name="fsm", used_by=(), highlight=None):
+    '''
+    DOT of an FSMPlan. The <trigger>_ing states are dashed, error is red, the initial state is doubled
+    used_by: names of the nodes using it, highlight: a state to fill in (the current one)
+    '''
+    lines = [f"digraph {_quote(name)} {{", "  rankdir=LR;", "  node [shape=box, style=rounded];"]
+    if used_by:
+        shown = list(used_by)[:5]
+        more = f" and {len(used_by)-5} more" if len(used_by) > 5 else ""
+        lines.append(f"  label={_quote('used by ' + ', '.join(shown) + more)}; labelloc=t;")
+    for state in fsm.states:
+        attributes = []
+        if state in fsm.ing_states:
+            attributes.append('style="rounded,dashed"')
+        if state == "error":
+            attributes.append("color=red")
+        if state == fsm.initial:
+            attributes.append("peripheries=2")
+        if state == highlight:
+            attributes.append('style="rounded,filled"')
+            attributes.append("fillcolor=lightblue")
+        lines.append(f"  {_quote(state)} [{', '.join(attributes)}];" if attributes else f"  {_quote(state)};")
+    for trigger, source, dest in fsm.transitions:
+        style = ", style=dotted" if trigger.startswith("end_") else ""
+        lines.append(f"  {_quote(source)} -> {_quote(dest)} [label={_quote(trigger)}{style}];")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def distinct_fsms(topnode):
+    '''
+    {FSMPlan: [names of the nodes with children using it]}, the leaves use their parent's
+    '''
+    fsms = {}
+    stack = [topnode]
+    while stack:
+        node = stack.pop()
+        fsms.setdefault(node.fsm_config.fsm, []).append(node.name)
+        stack.extend(child for child in node.children if child.children)
+    return fsms
+
+
+def _record(text):
+    ## Escapes what means something in a record label
+    for c in '\\{}|<>"':
+        text = text.replace(c, "\\"+c)
+    return text
+
+
+def tree_dot(topnode, name="tree"):
+    '''
+    DOT of the tree: one box per node with children, with its state and the states of its leaves, counted
+    '''
+    lines = [f"digraph {_quote(name)} {{", "  rankdir=TB;", "  node [shape=record, fontsize=10];"]
+    ids = {}
+    for node in PreOrderIter(topnode, stop=lambda n: not n.children and n is not topnode):
+        ids[node] = f"n{len(ids)}"
+        counts = {}
+        for child in node.children:
+            if not child.children:
+                counts[child.state] = counts.get(child.state, 0) + 1
+        label = _record(node.name) + "\\n" + _record(str(node.state))
+        if counts:
+            label += "|" + "".join(f"{count} {_record(str(state))}\\l" for state, count in sorted(counts.items()))
+        color = ", color=red" if node.state == "error" or "error" in counts else ""
+        lines.append(f"  {ids[node]} [label=\"{{{label}}}\"{color}];")
+        if node.parent in ids:
+            lines.append(f"  {ids[node.parent]} -> {ids[node]};")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def to_svg(dot_text):
+    ## Needs the graphviz "dot" executable
+    dot = shutil.which("dot")
+    if dot is None:
+        raise RuntimeError("graphviz isn't installed (no \"dot\" executable), only DOT files can be written")
+    return subprocess.run([dot, "-Tsvg"], input=dot_text.encode(), capture_output=True, check=True).stdout.decode()
+
+
+def export(topnode, directory, format="dot"):
+    '''
+    Writes fsm_<first node>.<format> for each distinct FSM (fsm_<first node>_2... when the first nodes of
+    different FSMs have the same name, in different branches) and tree.<format> in directory
+    Returns the paths written
+    '''
+    if format not in ["dot", "svg"]:
+        raise ValueError(f"Can't write \"{format}\", only dot or svg")
+    os.makedirs(directory, exist_ok=True)
+    documents = {}
+    for fsm, used_by in distinct_fsms(topnode).items():
+        highlight = topnode.state if fsm is topnode.fsm_config.fsm else None
+        name = f"fsm_{used_by[0]}"
+        n = 1
+        while name in documents:
+            n += 1
+            name = f"fsm_{used_by[0]}_{n}"
+        documents[name] = fsm_dot(fsm, name, used_by, highlight)
+    documents["tree"] = tree_dot(topnode)
+
+    paths = []
+    for name, text in documents.items():
+        path = os.path.join(directory, f"{name}.{format}")
+        if format == "svg":
+            text = to_svg(text)
+        with open(path, "w") as f:
+            f.write(text)
+        paths.append(path)
+    return paths
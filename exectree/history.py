@@ -0,0 +1,131 @@
+'''
+The last transitions of each node: trigger, start, end and outcome, in a ring allocated with the first one
+
+  top.history("conf", path="*/wibs/*", within=3600, slowest=20)   # the 20 slowest conf of the wibs in the last hour
+  history.latencies(top.history("conf"))                          # count, median, 90th and 99th percentiles, max
+
+A node only keeps its SIZE last transitions, whatever runs for how long. They are timed on the node's
+clock: time.time() on threads, the virtual one in a simulation.
+'''
+import math
+from array import array
+from typing import NamedTuple
+
+SIZE = 16
+
+RUNNING, SUCCESS, ERROR = 0, 1, 2
+OUTCOMES = {RUNNING: "running", SUCCESS: "success", ERROR: "error"}
+
+
+class Record(NamedTuple):
+    path: str
+    trigger: str
+    start: float
+    end: float # nan while it's running
+    duration: float
+    outcome: str # running, success or error
+
+
+class History():
+    '''
+    The ring of one node, as arrays rather than one object per transition
+    '''
+    __slots__ = ["triggers", "starts", "ends", "outcomes", "count"]
+
+    def __init__(self, size=None):
+        size = size or SIZE
+        self.triggers = [None]*size
+        self.starts = array("d", bytes(8*size))
+        self.ends = array("d", bytes(8*size))
+        self.outcomes = array("b", bytes(size))
+        self.count = 0 # ever recorded, the last one is at (count-1) % size
+
+
+    def start(self, trigger, now):
+        if self.count and self.outcomes[(self.count-1) % len(self.triggers)] == RUNNING:
+            # the node was put in another state without the end of that one (set_state), it didn't go through
+            self.end(now, False)
+        i = self.count % len(self.triggers)
+        self.triggers[i] = trigger
+        self.starts[i] = now
+        self.ends[i] = math.nan
+        self.outcomes[i] = RUNNING
+        self.count += 1
+
+
+    def end(self, now, success):
+        ## Of the last one started if it's running, a node doesn't run two transitions at once
+        if self.count == 0:
+            return
+        i = (self.count-1) % len(self.triggers)
+        if self.outcomes[i] == RUNNING:
+            self.ends[i] = now
+            self.outcomes[i] = SUCCESS if success else ERROR
+
+
+    def __len__(self):
+        return min(self.count, len(self.triggers))
+
+
+    def __iter__(self):
+        ## (trigger, start, end, outcome), the oldest first
+        size = len(self.triggers)
+        for n in range(self.count-len(self), self.count):
+            i = n % size
+            yield self.triggers[i], self.starts[i], self.ends[i], OUTCOMES[self.outcomes[i]]
+
+
+    def last_success(self):
+        ## The trigger of the last transition that went through, None if there wasn't any
+        size = len(self.triggers)
+        for n in range(self.count-1, self.count-len(self)-1, -1):
+            if self.outcomes[n % size] == SUCCESS:
+                return self.triggers[n % size]
+        return None
+
+
+def query(topnode, trigger=None, path=None, state=None, tag=None, within=None, outcome=None, slowest=None):
+    '''
+    The transitions of the selected nodes (see select) that are still in their history, as Records
+    trigger: a name or a list of them, within: started at most that many seconds ago, outcome: running,
+    success or error, slowest: only the n longest (the running ones count until now)
+    In the order they started, or the slowest first
+    '''
+    from .multicast import select
+    triggers = {trigger} if isinstance(trigger, str) else set(trigger) if trigger is not None else None
+    now = topnode._clock()
+    records = []
+    for node_path, node in select(topnode, path, state, tag):
+        ring = node._history
+        if ring is None:
+            continue
+        for name, start, end, result in ring:
+            if triggers is not None and name not in triggers:
+                continue
+            if within is not None and start < now-within:
+                continue
+            if outcome is not None and result != outcome:
+                continue
+            duration = (now if math.isnan(end) else end) - start
+            records.append(Record(node_path, name, start, end, duration, result))
+    if slowest is not None:
+        return sorted(records, key=lambda record: record.duration, reverse=True)[:slowest]
+    return sorted(records, key=lambda record: record.start)
+
+
+def latencies(records):
+    '''
+    {trigger: {"count", "p50", "p90", "p99", "max"}} of the durations of the records (see query), in seconds
+    '''
+    durations = {}
+    for record in records:
+        if record.outcome != "running":
+            durations.setdefault(record.trigger, []).append(record.duration)
+    summary = {}
+    for trigger, values in durations.items():
+        values.sort()
+        def percentile(p):
+            return values[min(int(p*len(values)), len(values)-1)]
+        summary[trigger] = {"count": len(values), "p50": percentile(.5), "p90": percentile(.9),
+                            "p99": percentile(.99), "max": values[-1]}
+    return summary
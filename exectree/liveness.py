@@ -0,0 +1,304 @@
+'''
+Liveness of the leaves between commands, so that an application that died doesn't stay "started" forever
+
+  "app": {..., "heartbeat": {"interval": 5, "misses": 3}}
+
+A leaf with a heartbeat (inherited like the rest of the configuration, null switches it off) is watched from create_fsms(), while
+it is in one of the checked states: "states" in the heartbeat, all of them but the initial one, the _ing
+ones and error by default. Every interval it is checked: if its class defines user_health_check(), that is
+called, and a falsy return or an exception is a miss. Otherwise the application is expected to have
+called leaf.heartbeat() since the previous check. After "misses" misses in a row, the leaf goes on error,
+and so do those of its ancestors whose fan-in policy fails with it (quorum=50% doesn't for one child out
+of ten), with the leaf in the "failed" of their status as after a failed transition.
+
+All the leaves are checked from a single thread, by a hierarchical timer wheel: scheduling a check is a
+list append, and the thread wakes up once per tick whatever the number of leaves. The checks are jittered
+("jitter", 0.1 of the interval by default) so that 10k leaves don't come due on the same tick.
+user_health_check() runs on that thread: it should be quick, a slow one delays the checks of the others.
+'''
+import json
+import random
+import threading
+import time
+
+from anytree import PreOrderIter
+
+from . import metrics
+from .simple import _report
+
+TICK = 0.1
+
+DEFAULT_MISSES = 3
+DEFAULT_JITTER = 0.1
+
+
+class TimerWheel():
+    '''
+    Items due in so many ticks, in levels of slots: a slot of a level spans a whole turn of the level below,
+    and is spread over it when that level comes round to it. What is further than the last level waits in
+    overflow. Adding is O(1), and advancing one tick only looks at what is due (and at what cascades)
+    '''
+    def __init__(self, slots=64, levels=3):
+        self.slots = slots
+        self.levels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self.overflow = []
+        self.now = 0 # in ticks
+
+
+    def add(self, ticks, item):
+        ## item is due ticks from now (at least the next tick)
+        self._place(self.now + max(ticks, 1), item)
+
+
+    def _place(self, due, item):
+        delta = due - self.now
+        span = 1
+        for level in self.levels:
+            if delta < span*self.slots:
+                level[(due//span) % self.slots].append((due, item))
+                return
+            span *= self.slots
+        self.overflow.append((due, item))
+
+
+    def advance(self):
+        ## One tick more, returns the items that are now due
+        self.now += 1
+        span = self.slots**(len(self.levels)-1)
+        if self.now % (span*self.slots) == 0 and self.overflow:
+            overflow, self.overflow = self.overflow, []
+            for due, item in overflow:
+                self._place(due, item)
+        # from the top, so that what cascades from one level can cascade again into the next one
+        for level in reversed(self.levels[1:]):
+            if self.now % span == 0:
+                slot = (self.now//span) % self.slots
+                entries, level[slot] = level[slot], []
+                for due, item in entries:
+                    self._place(due, item)
+            span //= self.slots
+        slot = self.now % self.slots
+        entries, self.levels[0][slot] = self.levels[0][slot], []
+        return [item for _, item in entries]
+
+
+class Watch():
+    '''
+    What the monitor knows of a leaf
+    '''
+    __slots__ = ["leaf", "root", "heartbeat", "interval", "misses", "jitter", "states", "missed", "beat", "checked", "active"]
+
+    def __init__(self, leaf, root, heartbeat):
+        fsm = leaf.fsm_config.fsm
+        self.leaf = leaf
+        self.root = root
+        self.heartbeat = heartbeat
+        self.interval = heartbeat["interval"]
+        self.misses = heartbeat.get("misses", DEFAULT_MISSES)
+        self.jitter = heartbeat.get("jitter", DEFAULT_JITTER)
+        self.states = frozenset(heartbeat.get("states") or
+                                [s for s in fsm.states if s not in fsm.ing_states and s not in ["error", fsm.initial]])
+        self.missed = 0
+        self.beat = 0.
+        self.checked = time.monotonic()
+        self.active = True
+
+
+    def next_check(self):
+        ## In ticks
+        interval = self.interval * (1. + self.jitter*random.uniform(-1., 1.))
+        return max(round(interval/TICK), 1)
+
+
+class Monitor():
+    '''
+    The thread checking the watched leaves
+    '''
+    def __init__(self):
+        self.wheel = TimerWheel()
+        self.watches = {} # leaf -> Watch
+        self.lock = threading.Lock() # for the wheel
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="exectree_liveness", daemon=True)
+        self.thread.start()
+
+
+    def watch(self, topnode):
+        '''
+        Watches the leaves below topnode that have a heartbeat, forgets those that don't (anymore)
+        Returns how many are watched
+        '''
+        watched = set()
+        for leaf in PreOrderIter(topnode, filter_=lambda node: not node.children):
+            heartbeat = leaf.fsm_config.heartbeat
+            if not heartbeat:
+                continue
+            watched.add(leaf)
+            old = self.watches.get(leaf)
+            if old is not None and old.active and old.root is topnode and old.heartbeat == heartbeat:
+                continue
+            if old is not None:
+                old.active = False
+            watch = Watch(leaf, topnode, heartbeat)
+            self.watches[leaf] = watch
+            with self.lock:
+                # the first check anywhere within the first interval
+                self.wheel.add(random.randint(1, watch.next_check()), watch)
+        self._forget(lambda watch: watch.root is topnode and watch.leaf not in watched)
+        return len(watched)
+
+
+    def unwatch(self, topnode):
+        self._forget(lambda watch: watch.root is topnode)
+
+
+    def _forget(self, condition):
+        ## They are dropped from the wheel when they come due
+        for leaf, watch in list(self.watches.items()):
+            if condition(watch):
+                watch.active = False
+                self.watches.pop(leaf, None)
+
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+
+    def _run(self):
+        start = time.monotonic()
+        while not self.stopping.wait(max(start + (self.wheel.now+1)*TICK - time.monotonic(), 0.)):
+            # if the checks took longer than a tick, the wheel catches up
+            dead = []
+            while self.wheel.now < (time.monotonic()-start)/TICK:
+                with self.lock:
+                    due = self.wheel.advance()
+                for watch in due:
+                    if not watch.active:
+                        continue
+                    failure = self._check(watch)
+                    if failure is not None:
+                        dead.append((watch.leaf, failure))
+                    elif watch.active:
+                        with self.lock:
+                            self.wheel.add(watch.next_check(), watch)
+            if dead:
+                _escalate(dead)
+
+
+    def _check(self, watch):
+        ## The failure, if that was one miss too many
+        leaf = watch.leaf
+        now = time.monotonic()
+        sender = leaf._command_sender
+        if sender is not None and sender.stopping.is_set():
+            watch.active = False
+            return None
+        if leaf.state not in watch.states:
+            # not running yet, or busy with a transition: it gets a whole interval once it's there
+            watch.missed = 0
+            watch.checked = now
+            return None
+
+        reason = None
+        health_check = getattr(type(leaf), "user_health_check", None)
+        if health_check is not None:
+            try:
+                if not health_check(leaf):
+                    reason = "user_health_check returned false"
+            except Exception as e:
+                reason = f"user_health_check raised {type(e).__name__}: {e}"
+        elif watch.beat < watch.checked:
+            reason = f"no heartbeat for {now-max(watch.beat, watch.checked):.1f}s"
+        watch.checked = now
+
+        if reason is None:
+            watch.missed = 0
+            return None
+        watch.missed += 1
+        if metrics.registry is not None:
+            metrics.registry.inc("exectree_heartbeats_missed_total", (("class", type(leaf).__name__),))
+        if watch.missed < watch.misses:
+            return None
+
+        # the leaf is given up on, until create_fsms() or a reload watches it again
+        watch.active = False
+        if self.watches.get(leaf) is watch:
+            del self.watches[leaf]
+        return {
+            "status": "heartbeat missed",
+            "node": leaf.name,
+            "state": leaf.state,
+            "trigger": "heartbeat",
+            "exception": reason,
+            "misses": watch.missed,
+        }
+
+
+def _escalate(dead):
+    '''
+    Puts the dead leaves on error, and their ancestors if their fan-in policy says so: the children on
+    error count as failed, the others as succeeded, as if they had all just answered a transition
+    Everything goes through the nodes' own threads, after whatever they are doing
+    '''
+    failed = {} # node -> failures of its children
+    lost = set() # going on error, whatever their state says yet
+    for leaf, failure in dead:
+        leaf.send_command(("to_error", json.dumps(failure)))
+        lost.add(leaf)
+        parent = leaf.parent
+        if parent is not None:
+            failed.setdefault(parent, []).append(failure)
+
+    # from the bottom, so that every node is reported once with all of its failed children
+    while failed:
+        node = max(failed, key=lambda n: n.depth)
+        failures = failed.pop(node)
+        if node.state == "error":
+            # its ancestors already know
+            continue
+        if node.state in node.fsm_config.fsm.ing_states:
+            # in the middle of a transition: the dead leaves will be heard by its fan-in, like any
+            # child failing it
+            continue
+        n_children = len(node.children)
+        n_failed = sum(1 for child in node.children if child in lost or child.state == "error")
+        policy = node.fsm_config.fan_in_policy
+        if policy.verdict(n_children, n_children-n_failed, n_failed) != "failed":
+            node.console.log(f"{node.name} lost {[f['node'] for f in failures]}, {n_failed}/{n_children} children on error are fine with {policy.name}")
+            continue
+        d = _report(node, "heartbeat", failures, [], "failed")
+        node.console.log(f"Sh*t the f*n... {node.name} lost {[f['node'] for f in failures]}")
+        node.send_command(("to_error", json.dumps(d)))
+        lost.add(node)
+        parent = node.parent
+        if parent is not None:
+            failed.setdefault(parent, []).append(d)
+
+
+# the one checking all the trees, started with the first leaf to watch
+monitor = None
+_monitor_lock = threading.Lock()
+
+
+def watch(topnode):
+    ## See Monitor.watch
+    global monitor
+    with _monitor_lock:
+        if monitor is None:
+            if not any(node.fsm_config.heartbeat for node in PreOrderIter(topnode)):
+                return 0
+            monitor = Monitor()
+    return monitor.watch(topnode)
+
+
+def unwatch(topnode):
+    if monitor is not None:
+        monitor.unwatch(topnode)
+
+
+def beat(leaf):
+    ## On the thread of the application, nothing but a timestamp
+    watch = monitor.watches.get(leaf) if monitor is not None else None
+    if watch is not None:
+        watch.beat = time.monotonic()
@@ -0,0 +1,228 @@
+'''
+Counters and timings of what the tree does, for capacity planning and to spot the slow applications
+
+  from exectree import metrics
+  registry = metrics.enable()
+  ...
+  registry.snapshot(tree)                  # a dictionary
+  registry.write(tree, "exectree.prom")    # Prometheus text format, for the node exporter's textfile collector
+  registry.serve(tree, port=9464)          # or scraped from http://127.0.0.1:9464/metrics
+
+Nothing is counted until enable(), the hot paths only check that metrics.registry isn't None.
+The queue depths and the number of nodes in each state are gathered when the metrics are read,
+the rest is updated as it happens. Everything is labelled by node class, not by node, so that
+10k applications don't make 10k series.
+'''
+import os
+import threading
+import time
+
+from anytree import PreOrderIter
+
+# the registry in use, None when the metrics are off
+registry = None
+
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1., 5., 15., 60.)
+
+HELP = {
+    "exectree_commands_total": ("counter", "Commands executed by the nodes' threads"),
+    "exectree_command_seconds_total": ("counter", "Time spent executing the commands"),
+    "exectree_transitions_total": ("counter", "Transitions finished, by status (success, failed, timeout)"),
+    "exectree_fan_in_seconds": ("histogram", "Time a node waits for its children"),
+    "exectree_user_code_seconds": ("histogram", "Time taken by the user code of the leaves"),
+    "exectree_state_seconds_total": ("counter", "Time spent in each state, counted when leaving it"),
+    "exectree_heartbeats_missed_total": ("counter", "Liveness checks of the leaves that failed (see liveness.py)"),
+    "exectree_command_queue_depth_max": ("gauge", "Deepest command queue"),
+    "exectree_command_queue_depth_sum": ("gauge", "Commands waiting in all the command queues"),
+    "exectree_status_queue_depth_max": ("gauge", "Deepest queue of replies from the children"),
+    "exectree_nodes": ("gauge", "Nodes in each state"),
+}
+
+
+class Registry():
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {} # (name, labels) -> value, labels being a tuple of (key, value)
+        self.histograms = {} # (name, labels) -> [count per bucket..., +Inf, sum]
+        self.state_since = {} # node -> when it entered its state, until it leaves the tree (see forget)
+
+
+    def inc(self, name, labels, value=1.):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0.) + value
+
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0]*(len(self.buckets)+1) + [0.]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[len(self.buckets)] += 1
+            histogram[-1] += value
+
+
+    def _state_changed(self, node, source):
+        ## A state listener (see simple.py)
+        now = time.monotonic()
+        since = self.state_since.get(node)
+        self.state_since[node] = now
+        if since is not None and source is not None:
+            self.inc("exectree_state_seconds_total", (("class", type(node).__name__), ("state", source)), now-since)
+
+
+    def forget(self, topnode):
+        ## The nodes below topnode (included) leave the tree, reload or quit: they aren't kept alive here
+        for node in PreOrderIter(topnode):
+            self.state_since.pop(node, None)
+
+
+    def _gauges(self, topnode):
+        ## What is read from the tree itself
+        gauges = {}
+        def set_max(key, value):
+            gauges[key] = max(gauges.get(key, 0), value)
+
+        for node in PreOrderIter(topnode):
+            klass = (("class", type(node).__name__),)
+            key = ("exectree_nodes", klass+(("state", str(node.state)),))
+            gauges[key] = gauges.get(key, 0) + 1
+            if node._command_sender is not None:
+                depth = node._command_sender.queue.qsize()
+                set_max(("exectree_command_queue_depth_max", klass), depth)
+                key = ("exectree_command_queue_depth_sum", klass)
+                gauges[key] = gauges.get(key, 0) + depth
+            if node.status_receiver_queue is not None:
+                set_max(("exectree_status_queue_depth_max", klass), node.status_receiver_queue.qsize())
+        return gauges
+
+
+    def snapshot(self, topnode=None):
+        '''
+        {"counters": {name: {labels: value}}, "histograms": {name: {labels: {"buckets", "count", "sum"}}}, "gauges": ...}
+        labels being "key=value,key=value". The gauges need the tree
+        '''
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+        gauges = self._gauges(topnode) if topnode is not None else {}
+
+        def label_text(labels):
+            return ",".join(f"{k}={v}" for k, v in labels)
+
+        snapshot = {"counters": {}, "histograms": {}, "gauges": {}}
+        for (name, labels), value in counters.items():
+            snapshot["counters"].setdefault(name, {})[label_text(labels)] = value
+        for (name, labels), value in gauges.items():
+            snapshot["gauges"].setdefault(name, {})[label_text(labels)] = value
+        for (name, labels), histogram in histograms.items():
+            snapshot["histograms"].setdefault(name, {})[label_text(labels)] = {
+                "buckets": dict(zip([str(b) for b in self.buckets]+["+Inf"], histogram[:-1])),
+                "count": sum(histogram[:-1]),
+                "sum": histogram[-1],
+            }
+        return snapshot
+
+
+    def prometheus(self, topnode=None):
+        '''
+        Everything in Prometheus text format
+        '''
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+        gauges = self._gauges(topnode) if topnode is not None else {}
+
+        def label_text(labels):
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+        # the series sorted by labels, the buckets of a histogram in increasing order
+        by_name = {}
+        for values in [counters, gauges]:
+            for (name, labels), value in sorted(values.items()):
+                by_name.setdefault(name, []).append(f"{name}{label_text(labels)} {value}")
+        for (name, labels), histogram in sorted(histograms.items()):
+            lines = by_name.setdefault(name, [])
+            cumulated = 0
+            for bound, count in zip([str(b) for b in self.buckets]+["+Inf"], histogram[:-1]):
+                cumulated += count
+                lines.append(f"{name}_bucket{label_text(labels+(('le', bound),))} {cumulated}")
+            lines.append(f"{name}_count{label_text(labels)} {cumulated}")
+            lines.append(f"{name}_sum{label_text(labels)} {histogram[-1]}")
+
+        text = []
+        for name in sorted(by_name):
+            kind, description = HELP.get(name, ("untyped", name))
+            text += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"] + by_name[name]
+        return "\n".join(text) + "\n"
+
+
+    def write(self, topnode, path):
+        ## Atomically, for the node exporter's textfile collector
+        import tempfile
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(self.prometheus(topnode))
+        os.replace(tmp, path)
+
+
+    def serve(self, topnode, port=9464, host="127.0.0.1"):
+        '''
+        Serves /metrics on a thread of its own, returns the server (server.shutdown() to stop it)
+        '''
+        import http.server
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.prometheus(topnode).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="exectree_metrics", daemon=True).start()
+        return server
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def enable(buckets=BUCKETS):
+    '''
+    Starts counting, returns the registry (the same one if it was already on)
+    '''
+    global registry
+    if registry is None:
+        from .simple import _state_listeners
+        registry = Registry(buckets)
+        _state_listeners.append(registry._state_changed)
+    return registry
+
+
+def disable():
+    global registry
+    if registry is not None:
+        from .simple import _state_listeners
+        _state_listeners.remove(registry._state_changed)
+        registry = None
@@ -0,0 +1,131 @@
+'''
+Commands sent to a selection of nodes anywhere in the tree, rather than to one node and all its children
+
+A selection is made of a path glob ("np04_vst/wibs/wib[12]", "*" also matches across "/"), a state
+(a name, a list of names or a function of the state) and a tag (from the "tags" of the configuration).
+The selected nodes all get the command at once, on their own threads, and the results are gathered
+as they finish. Their ancestors then follow if all their children agree on a state.
+'''
+import fnmatch
+import json
+import time
+from queue import SimpleQueue, Empty
+
+from .simple import _state_listeners, _add_waiter, _remove_waiter
+
+
+def _walk(node, path):
+    yield node, path
+    for child in node.children:
+        yield from _walk(child, path+"/"+child.name)
+
+
+def _state_matches(state, wanted):
+    if wanted is None:
+        return True
+    if callable(wanted):
+        return wanted(state)
+    if isinstance(wanted, str):
+        return state == wanted
+    return state in wanted
+
+
+def select(topnode, path=None, state=None, tag=None):
+    '''
+    The nodes below topnode (included) matching all the given criteria, with their paths
+    Returns a list of (path, node), in tree order
+    '''
+    selected = []
+    for node, node_path in _walk(topnode, topnode.name):
+        if path is not None and not fnmatch.fnmatchcase(node_path, path):
+            continue
+        if tag is not None and tag not in node.fsm_config.tags:
+            continue
+        if not _state_matches(node.state, state):
+            continue
+        selected.append((node_path, node))
+    return selected
+
+
+def _reconcile(nodes):
+    ## The ancestors of the nodes that moved take the state their children agree on, deepest first,
+    ## without going through the transition: their children already did the work
+    ancestors = {ancestor for node in nodes for ancestor in node.ancestors}
+    changed = []
+    for ancestor in sorted(ancestors, key=lambda a: len(a.ancestors), reverse=True):
+        if ancestor.state in ancestor.fsm_config.fsm.ing_states:
+            continue # it's busy with a transition of its own, that'll settle it
+        states = {child.state for child in ancestor.children}
+        if len(states) == 1 and ancestor.state not in states:
+            state = states.pop()
+            # a child still in the middle of a transition isn't a state to agree on
+            if state in ancestor.fsm_config.fsm.states and state not in ancestor.fsm_config.fsm.ing_states:
+                source = ancestor.state
+                ancestor.fsm.set_state(state, model=ancestor)
+                changed.append(ancestor.name)
+                for listener in _state_listeners:
+                    listener(ancestor, source)
+    return changed
+
+
+def multicast(topnode, command, path=None, state=None, tag=None, timeout=15.):
+    '''
+    Sends command to the nodes selected below topnode (see select), and waits at most timeout for all of them
+    A selected node below another selected node is left to its ancestor's transition
+    The nodes that can't do the command in their current state are skipped
+    Returns a summary: the paths that succeeded, failed (with their message), timed out or were skipped,
+    and the ancestors which changed state
+    '''
+    targets = {} # node -> path
+    skipped = []
+    for node_path, node in select(topnode, path, state, tag):
+        if any(ancestor in targets for ancestor in node.ancestors):
+            continue
+        event = node.fsm.events.get(command) if node.fsm is not None else None
+        if event is None or node.state not in event.transitions:
+            skipped.append(node_path)
+            continue
+        targets[node] = node_path
+
+    # registered before sending, so that nothing is missed
+    waiter = SimpleQueue()
+    for node in targets:
+        _add_waiter(node, waiter)
+    try:
+        for node in targets:
+            node.send_command(command)
+
+        remaining = dict(targets)
+        succeeded, failed = [], {}
+        deadline = time.monotonic() + timeout
+        while remaining:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            try:
+                node, message = waiter.get(timeout=left)
+            except Empty:
+                break
+            response = json.loads(message)
+            if response.get("trigger") != command or node not in remaining:
+                continue
+            node_path = remaining.pop(node)
+            if response.get("status") == "success":
+                succeeded.append(node_path)
+            else:
+                failed[node_path] = response
+    finally:
+        for node in targets:
+            _remove_waiter(node, waiter)
+
+    timed_out = list(remaining.values())
+    if timed_out:
+        topnode.console.log(f"{command} timed out after {timeout}s on {timed_out}")
+    return {
+        "command": command,
+        "success": succeeded,
+        "failed": failed,
+        "timeout": timed_out,
+        "skipped": skipped,
+        "reconciled": _reconcile(targets),
+    }
@@ -0,0 +1,350 @@
+'''
+Compiles the json configuration of a tree into an immutable plan, checking upfront
+everything that used to blow up in the middle of a command
+
+Keys starting with "_" are ignored, that's the way to comment things out in json
+Children named like "wib[1-480]" (or "wib[001-480]", zero padded) stand for wib1 to wib480, all with
+the same value: a leaf template name, or a node configuration compiled once for all of them
+'''
+import difflib
+import json
+import re
+from types import MappingProxyType
+from typing import NamedTuple
+
+
+class ConfigError(RuntimeError):
+    '''
+    The configuration of the tree doesn't make sense, the message lists everything that's wrong with it
+    '''
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("Invalid tree configuration:\n - " + "\n - ".join(errors))
+
+
+NODE_KEYS = ["states", "initial", "transitions", "transition-conf", "state-conf", "included", "tags", "heartbeat", "children"]
+TRANSITION_KEYS = ["trigger", "source", "dest", "conf", "retry", "timeout", "barrier"]
+RETRY_KEYS = ["attempts", "backoff", "factor", "max-backoff", "on"]
+HEARTBEAT_KEYS = ["interval", "misses", "jitter", "states"]
+TRANSITION_CONF_WORDS = ["strict", "fail-fast", "complaisant", "wait-all", "long", "short"]
+
+
+class FSMPlan(NamedTuple):
+    '''
+    What a node's machine is made of, once every transition has been split into
+    trigger -> <trigger>_ing -> end_<trigger>
+    '''
+    states: tuple # declared states, then the _ing ones, then error
+    ing_states: tuple
+    transitions: tuple # (trigger, source, dest)
+    initial: str
+    user_callbacks: tuple # what the leaves need to define
+
+
+class NodePlan(NamedTuple):
+    name: str
+    path: str
+    config: MappingProxyType # the node's configuration merged with its parent's, without the children
+    fsm: FSMPlan
+    children: tuple # NodePlans, empty for the leaves
+    leaf: bool
+    template: str = None # what the leaf is, its value in the configuration (picks its class, see simple.load)
+
+
+_RANGE = re.compile(r"^(.*)\[(\d+)-(\d+)\](.*)$")
+
+
+def expand(name):
+    '''
+    "wib[1-3]" -> ["wib1", "wib2", "wib3"], "wib[08-10]" -> ["wib08", "wib09", "wib10"], other names are left alone
+    '''
+    match = _RANGE.match(name) if "[" in name else None
+    if match is None:
+        return [name]
+    prefix, first, last, suffix = match.groups()
+    numbers = map(str, range(int(first), int(last)+1))
+    if first.startswith("0") and len(first) > 1:
+        numbers = (number.zfill(len(first)) for number in numbers)
+    return [prefix+number+suffix for number in numbers]
+
+
+def _unknown_keys(where, d, known, errors):
+    for key in d:
+        if key.startswith("_") or key in known:
+            continue
+        close = difflib.get_close_matches(key, known, n=1)
+        hint = f", did you mean \"{close[0]}\"?" if close else ""
+        errors.append(f"{where}: unknown key \"{key}\"{hint}")
+
+
+def _check_transition_conf(where, transition_conf, errors):
+    if not isinstance(transition_conf, str):
+        errors.append(f"{where}: transition-conf should be a string like \"strict,long\"")
+        return
+    for word in transition_conf.split(","):
+        word = word.strip()
+        if word in TRANSITION_CONF_WORDS:
+            continue
+        if word.startswith("quorum="):
+            value = word[len("quorum="):]
+            try:
+                number = float(value[:-1]) if value.endswith("%") else int(value)
+            except ValueError:
+                number = -1
+            if number <= 0:
+                errors.append(f"{where}: can't understand \"{word}\", expected quorum=N or quorum=N%")
+            continue
+        close = difflib.get_close_matches(word, TRANSITION_CONF_WORDS, n=1)
+        hint = f", did you mean \"{close[0]}\"?" if close else ""
+        errors.append(f"{where}: unknown transition-conf \"{word}\"{hint}")
+
+
+def _check_retry(where, retry, errors):
+    if not isinstance(retry, dict):
+        errors.append(f"{where}: retry should be a dictionary")
+        return
+    _unknown_keys(where+" retry", retry, RETRY_KEYS, errors)
+    attempts = retry.get("attempts", 1)
+    if not isinstance(attempts, int) or attempts < 1:
+        errors.append(f"{where}: retry attempts should be a positive integer")
+    for key in ["backoff", "factor", "max-backoff"]:
+        if not isinstance(retry.get(key, 0), (int, float)) or retry.get(key, 0) < 0:
+            errors.append(f"{where}: retry {key} should be a positive number")
+    if "on" in retry and (not isinstance(retry["on"], list) or not all(isinstance(e, str) for e in retry["on"])):
+        errors.append(f"{where}: retry \"on\" should be a list of exception names")
+
+
+def _check_heartbeat(where, heartbeat, states, errors):
+    if heartbeat is None:
+        # no heartbeat below a node that has one
+        return
+    if not isinstance(heartbeat, dict):
+        errors.append(f"{where}: heartbeat should be a dictionary")
+        return
+    _unknown_keys(where+" heartbeat", heartbeat, HEARTBEAT_KEYS, errors)
+    interval = heartbeat.get("interval")
+    if isinstance(interval, bool) or not isinstance(interval, (int, float)) or interval <= 0:
+        errors.append(f"{where}: heartbeat interval should be a positive number of seconds")
+    misses = heartbeat.get("misses", 1)
+    if isinstance(misses, bool) or not isinstance(misses, int) or misses < 1:
+        errors.append(f"{where}: heartbeat misses should be a positive integer")
+    jitter = heartbeat.get("jitter", 0)
+    if isinstance(jitter, bool) or not isinstance(jitter, (int, float)) or not 0 <= jitter < 1:
+        errors.append(f"{where}: heartbeat jitter should be a fraction of the interval, between 0 and 1")
+    if "states" in heartbeat:
+        if not isinstance(heartbeat["states"], list):
+            errors.append(f"{where}: heartbeat states should be a list of states")
+        elif isinstance(states, list):
+            for state in heartbeat["states"]:
+                if state not in states:
+                    errors.append(f"{where}: heartbeat state \"{state}\" isn't in the states")
+
+
+def _check_fsm(where, config, errors):
+    states = config.get("states")
+    transitions = config.get("transitions")
+    if not isinstance(states, list) or not states or not all(isinstance(s, str) for s in states):
+        errors.append(f"{where}: \"states\" should be a non empty list of names")
+        return
+    if not isinstance(transitions, list):
+        errors.append(f"{where}: \"transitions\" should be a list")
+        return
+    if config.get("initial") is not None and config["initial"] not in states:
+        errors.append(f"{where}: initial state \"{config['initial']}\" isn't in the states")
+
+    for i, transition in enumerate(transitions):
+        twhere = f"{where} transition #{i}"
+        if not isinstance(transition, dict):
+            errors.append(f"{twhere}: should be a dictionary")
+            continue
+        twhere = f"{where} transition \"{transition.get('trigger', i)}\""
+        _unknown_keys(twhere, transition, TRANSITION_KEYS, errors)
+        for key in ["trigger", "source", "dest"]:
+            if not isinstance(transition.get(key), str):
+                errors.append(f"{twhere}: \"{key}\" is missing")
+        for key in ["source", "dest"]:
+            if isinstance(transition.get(key), str) and transition[key] not in states:
+                errors.append(f"{twhere}: {key} \"{transition[key]}\" isn't in the states")
+        if "retry" in transition:
+            _check_retry(twhere, transition["retry"], errors)
+        if "timeout" in transition and (isinstance(transition["timeout"], bool) or
+                                        not isinstance(transition["timeout"], (int, float)) or transition["timeout"] <= 0):
+            errors.append(f"{twhere}: timeout should be a positive number of seconds")
+        if "barrier" in transition and not isinstance(transition["barrier"], bool):
+            errors.append(f"{twhere}: barrier should be true or false")
+
+
+def validate(config):
+    '''
+    Checks a whole tree configuration (already parsed from json), and raises a ConfigError listing
+    all the problems. Returns the name of the top node
+    '''
+    errors = []
+    if not isinstance(config, dict) or len(config) != 1:
+        raise ConfigError(["JSon should have exactly 1 key"])
+    top = list(config.keys())[0]
+
+    def check_node(name, node_config, parent_config, path):
+        if not isinstance(node_config, dict):
+            errors.append(f"{path}: \"{node_config}\" I don't know what that's supposed to mean?")
+            return
+        _unknown_keys(path, node_config, NODE_KEYS, errors)
+        if "included" in node_config and not isinstance(node_config["included"], bool):
+            errors.append(f"{path}: \"included\" should be true or false")
+        if "tags" in node_config and (not isinstance(node_config["tags"], list) or
+                                      not all(isinstance(tag, str) for tag in node_config["tags"])):
+            errors.append(f"{path}: \"tags\" should be a list of names")
+        if "transition-conf" in node_config:
+            _check_transition_conf(path, node_config["transition-conf"], errors)
+
+        merged = {**parent_config, **{k: v for k, v in node_config.items() if k != "children"}}
+        if "heartbeat" in node_config:
+            _check_heartbeat(path, node_config["heartbeat"], merged.get("states"), errors)
+        # only check the FSM where it's (re)defined
+        if not parent_config or "states" in node_config or "transitions" in node_config or "initial" in node_config:
+            _check_fsm(path, merged, errors)
+
+        children = node_config.get("children", {})
+        if not isinstance(children, dict):
+            errors.append(f"{path}: \"children\" should be a dictionary")
+            return
+        if any("[" in child_name for child_name in children):
+            names = set()
+            for child_name in children:
+                match = _RANGE.match(child_name)
+                if match is not None and int(match.group(2)) > int(match.group(3)):
+                    errors.append(f"{path}/{child_name}: the range is empty")
+                for name in expand(child_name):
+                    if name in names:
+                        errors.append(f"{path}/{name}: defined twice")
+                    names.add(name)
+        for child_name, value in children.items():
+            child_path = path+"/"+child_name
+            if "/" in child_name:
+                errors.append(f"{child_path}: node names can't contain \"/\"")
+            if isinstance(value, str):
+                continue
+            # a range of nodes is checked once
+            check_node(child_name, value, merged, child_path)
+
+    check_node(top, config[top], {}, top)
+    if errors:
+        raise ConfigError(errors)
+    return top
+
+
+_fsm_plans = {}
+
+
+def derive_fsm(states, transitions, initial=None):
+    '''
+    The FSM of a node, every transition is long: it goes through a <trigger>_ing state
+    in which the node waits for its children (or runs the user code for a leaf)
+    Identical configurations share the same FSMPlan
+    '''
+    key = json.dumps([states, transitions, initial], sort_keys=True)
+    fsm = _fsm_plans.get(key)
+    if fsm is not None:
+        return fsm
+
+    ing_states = []
+    fsm_transitions = []
+    for transition in transitions:
+        name = transition["trigger"]+"_ing"
+        if name not in ing_states:
+            ing_states.append(name)
+        fsm_transitions.append((transition["trigger"], transition["source"], name))
+        fsm_transitions.append(("end_"+transition["trigger"], name, transition["dest"]))
+
+    all_states = list(states) + [s for s in ing_states if s not in states]
+    if "error" not in all_states:
+        all_states.append("error")
+
+    fsm = FSMPlan(
+        states = tuple(all_states),
+        ing_states = tuple(ing_states),
+        transitions = tuple(fsm_transitions),
+        initial = initial or states[0],
+        user_callbacks = tuple("user_on_enter_"+state for state in ing_states),
+    )
+    _fsm_plans[key] = fsm
+    return fsm
+
+
+def fsm_key(fsm):
+    ## The key derive_fsm filed this FSMPlan under (there are only a handful of distinct FSMs)
+    for key, plan in _fsm_plans.items():
+        if plan is fsm:
+            return key
+    raise KeyError(f"FSM {fsm.states} wasn't derived by derive_fsm")
+
+
+def register_fsm(key, fsm):
+    ## For FSMPlans coming from somewhere else (the plan cache), returns the one derive_fsm will hand out
+    return _fsm_plans.setdefault(key, fsm)
+
+
+def shortest_path(transitions, source, target):
+    '''
+    The triggers taking a node from source to target, as few as possible, with the transitions of the configuration
+    '''
+    if source == target:
+        return []
+    previous = {source: None} # state -> (trigger, state it came from)
+    frontier = [source]
+    while frontier:
+        next_frontier = []
+        for state in frontier:
+            for transition in transitions:
+                if transition["source"] != state or transition["dest"] in previous:
+                    continue
+                previous[transition["dest"]] = (transition["trigger"], state)
+                next_frontier.append(transition["dest"])
+        if target in previous:
+            break
+        frontier = next_frontier
+    if target not in previous:
+        raise ValueError(f"Can't get from {source} to {target} with these transitions")
+    path = []
+    state = target
+    while previous[state] is not None:
+        trigger, state = previous[state]
+        path.append(trigger)
+    return path[::-1]
+
+
+def compile_config(config):
+    '''
+    Validates the configuration (already parsed from json), and returns the NodePlan of the top node
+    '''
+    top = validate(config)
+    new = tuple.__new__
+    # (node configuration, parent configuration) -> (merged configuration, FSM), the nodes of a range share them
+    merged = {}
+
+    def compile_node(name, node_config, parent_config, parent_fsm, path):
+        key = (id(node_config), id(parent_config))
+        if key in merged:
+            config, fsm = merged[key]
+        else:
+            own = {k: v for k, v in node_config.items() if k != "children" and not k.startswith("_")}
+            if parent_config is not None and not own:
+                config, fsm = parent_config, parent_fsm
+            else:
+                config = MappingProxyType({**(parent_config or {}), **own})
+                fsm = derive_fsm(config["states"], config["transitions"], config.get("initial"))
+            merged[key] = (config, fsm)
+
+        children = []
+        prefix = path+"/"
+        for child_name, value in node_config.get("children", {}).items():
+            names = expand(child_name) if "[" in child_name else (child_name,)
+            if isinstance(value, str):
+                # leaves, they only have their parent's configuration, made in bulk (NodePlan(...) checks its arguments)
+                template = value or None
+                children += [new(NodePlan, (leaf, prefix+leaf, config, fsm, (), True, template)) for leaf in names]
+            else:
+                children += [compile_node(child, value, config, fsm, prefix+child) for child in names]
+        return NodePlan(name, path, config, fsm, tuple(children), False)
+
+    return compile_node(top, config[top], None, None, top)
@@ -0,0 +1,167 @@
+'''
+Where the time of a slow transition goes: a sampling profiler of the nodes' threads
+
+  with profiler.profile(top.children[0], "boot.folded"):   # or p = Profiler(node).start() ... p.stop()
+      top.run_steps(["boot"])
+  flamegraph.pl boot.folded > boot.svg                     # or speedscope, they all read collapsed stacks
+
+Every interval, the stacks of the command sender threads of the nodes below the profiled one are read
+(sys._current_frames, from the profiler's own thread: the nodes don't do anything different). Each busy
+sample is put down to the node, its state and a phase:
+  user      the user_on_enter_* (or user_health_check) code of a leaf
+  json      the statuses being encoded or decoded
+  fan-in    a node waiting for its children, or counting their replies
+  dispatch  the transitions library, working out which callbacks to call
+  exectree  the rest of the machinery
+A thread waiting for its next command isn't sampled. Nothing is done while no profiler is running.
+A sample reads the stacks of all the threads of the process: with 2000 nodes' threads that's about 2.5 ms,
+a quarter of a CPU at the default 100 samples per second. When the interpreter is saturated the profiler
+gets fewer samples, each of them standing for the time since the previous one.
+'''
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from anytree import PreOrderIter
+
+from .sender import CommandSender
+
+INTERVAL = 0.01
+REFRESH = 1. # seconds between two looks for new threads in the subtree
+
+_IDLE = CommandSender.run.__code__
+_FAN_IN = {"_transition_with_interm", "_fan_in_start", "_fan_in_receive", "_fan_in_finish"}
+_JSON = os.path.dirname(__import__("json").__file__)
+_TRANSITIONS = os.path.dirname(__import__("transitions").__file__)
+
+
+def _phase(frame):
+    ## From the innermost frame out
+    innermost = frame.f_code.co_filename
+    phase = None
+    while frame is not None:
+        code = frame.f_code
+        name = code.co_name
+        if name.startswith("user_") or name == "_run_user_code":
+            return "user"
+        if phase is None and name in _FAN_IN:
+            phase = "fan-in"
+        frame = frame.f_back
+    if innermost.startswith(_JSON):
+        return "json"
+    if phase is not None:
+        return phase
+    if innermost.startswith(_TRANSITIONS):
+        return "dispatch"
+    return "exectree"
+
+
+def _frames(frame):
+    ## module:function, from the outermost
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        module = os.path.splitext(os.path.basename(code.co_filename))[0]
+        names.append(f"{module}:{code.co_name}")
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+
+class Profiler():
+    '''
+    Samples the threads of the nodes below topnode (included) every interval seconds, until stop()
+    per_node=False puts the samples down to the node classes rather than to the nodes, for big trees
+    '''
+    def __init__(self, topnode, interval=None, per_node=True):
+        self.topnode = topnode
+        self.interval = interval or INTERVAL
+        self.per_node = per_node
+        self.samples = Counter() # (node, state, phase, frames) -> number of samples
+        self.n_samples = 0
+        self.elapsed = 0.
+        self.stopping = threading.Event()
+        self.thread = None
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="exectree_profiler", daemon=True)
+        self.thread.start()
+        return self
+
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        return self
+
+
+    def _threads(self):
+        ## thread id -> node, for the nodes that have a thread (they get it with their first command)
+        return {node._command_sender.ident: node for node in PreOrderIter(self.topnode)
+                if node._command_sender is not None and node._command_sender.ident is not None}
+
+
+    def _run(self):
+        start = time.monotonic()
+        threads, refreshed = self._threads(), start
+        while not self.stopping.wait(self.interval):
+            now = time.monotonic()
+            if now - refreshed > REFRESH:
+                threads, refreshed = self._threads(), now
+            for ident, frame in sys._current_frames().items():
+                node = threads.get(ident)
+                if node is None or frame.f_code is _IDLE:
+                    continue
+                who = node.name if self.per_node else type(node).__name__
+                self.samples[(who, str(getattr(node, "_state", None)), _phase(frame), tuple(_frames(frame)))] += 1
+            self.n_samples += 1
+        self.elapsed = time.monotonic() - start
+
+
+    def seconds(self):
+        '''
+        {(node, state, phase): seconds}, the samples times the interval they stand for
+        '''
+        period = self.elapsed / self.n_samples if self.n_samples else self.interval
+        total = Counter()
+        for (who, state, phase, _), n in self.samples.items():
+            total[(who, state, phase)] += n*period
+        return dict(total)
+
+
+    def collapsed(self):
+        ## The lines of the collapsed stacks: node;state;phase;frame;...;frame count
+        lines = Counter()
+        for (who, state, phase, frames), n in self.samples.items():
+            lines[";".join([who, state, phase, *frames])] += n
+        return [f"{stack} {n}" for stack, n in sorted(lines.items())]
+
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for line in self.collapsed():
+                f.write(line+"\n")
+        return path
+
+
+class profile():
+    '''
+    Profiles the nodes below topnode while in the with block, and writes the collapsed stacks to path if given
+    '''
+    def __init__(self, topnode, path=None, interval=None, per_node=True):
+        self.profiler = Profiler(topnode, interval, per_node)
+        self.path = path
+
+
+    def __enter__(self):
+        return self.profiler.start()
+
+
+    def __exit__(self, *exc):
+        self.profiler.stop()
+        if self.path is not None:
+            self.profiler.write(self.path)
+        return False
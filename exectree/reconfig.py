@@ -0,0 +1,218 @@
+'''
+Applies a new configuration to a running tree, instead of quitting it and loading a new one
+
+The new plan is compared with the tree node by node: only the nodes that appear, disappear, move
+or whose configuration changed are touched, everything else keeps its state and its thread.
+The leaves are never visited one by one, unless their parent's configuration changed.
+New nodes below a running tree are taken to their parent's state, by going through the transitions.
+'''
+from . import metrics
+from .plan import ConfigError, shortest_path
+from .sender import shutdown
+from .simple import ExecLeaf, FSMConfig, _compile, _construct_node, _leaf_class, _machine, _watch_liveness
+
+
+class _Diff():
+    def __init__(self):
+        self.added = []        # (parent node, parent plan, plan)
+        self.removed = {}      # node -> its path
+        self.moved = []        # (node, new parent, parent plan, plan)
+        self.reconfigured = {} # node -> its new FSMConfig
+        self.reordered = {}    # node -> its plan, nodes whose children changed
+
+
+def _is_leaf(node):
+    return isinstance(node, ExecLeaf)
+
+
+def _target_config(node, plan, parent_plan, parent_config):
+    ## The FSMConfig the node should end up with
+    if parent_plan is not None and plan.config is parent_plan.config:
+        return parent_config
+    if node is not None and node.fsm_config.config_json == plan.config:
+        return node.fsm_config
+    return FSMConfig(plan.config)
+
+
+def _diff_node(diff, node, plan, parent_plan, parent_config):
+    config = _target_config(node, plan, parent_plan, parent_config)
+    if config is not node.fsm_config:
+        diff.reconfigured[node] = config
+
+    old = {child.name: child for child in node.children}
+    for child_plan in plan.children:
+        child = old.pop(child_plan.name, None)
+        if child is None or child_plan.leaf != _is_leaf(child):
+            if child is not None:
+                diff.removed[child] = plan.path+"/"+child.name
+            diff.added.append((node, plan, child_plan))
+            diff.reordered[node] = plan
+        elif child_plan.leaf:
+            if child.fsm_config is not config:
+                diff.reconfigured[child] = config
+        else:
+            _diff_node(diff, child, child_plan, plan, config)
+
+    for child in old.values():
+        diff.removed[child] = plan.path+"/"+child.name
+        diff.reordered[node] = plan
+    if node not in diff.reordered and [c.name for c in node.children] != [p.name for p in plan.children]:
+        diff.reordered[node] = plan
+    return config
+
+
+def _find_moves(diff):
+    ## A node that disappears somewhere and appears elsewhere with the same name is moved rather than
+    ## rebuilt, as long as the name isn't ambiguous
+    removed_by_name = {}
+    for node in diff.removed:
+        removed_by_name.setdefault(node.name, []).append(node)
+    added_names = [plan.name for _, _, plan in diff.added]
+
+    added = []
+    for parent, parent_plan, plan in diff.added:
+        candidates = removed_by_name.get(plan.name, [])
+        if len(candidates) != 1 or added_names.count(plan.name) != 1 or _is_leaf(candidates[0]) != plan.leaf:
+            added.append((parent, parent_plan, plan))
+            continue
+        node = candidates[0]
+        del diff.removed[node]
+        diff.moved.append((node, parent, parent_plan, plan))
+    diff.added = added
+
+
+def _check(diff, leaf_class, live):
+    ## Everything that would leave the tree half reconfigured is refused before touching anything
+    errors = []
+    if not live:
+        return errors
+    checked = set()
+
+    def missing(klass, fsm, where):
+        # once per leaf class and FSM, like create_fsms()
+        if (klass, fsm) in checked:
+            return
+        checked.add((klass, fsm))
+        errors.extend(f"{where} ({klass.__name__}) doesn't define {callback}"
+                      for callback in fsm.user_callbacks if not callable(getattr(klass, callback, None)))
+
+    for node, config in diff.reconfigured.items():
+        if config.fsm is node.fsm_config.fsm:
+            continue
+        if node.state in node.fsm_config.fsm.ing_states:
+            errors.append(f"{node.name} is busy with {node.state}, its FSM can't be changed now")
+        if _is_leaf(node):
+            missing(type(node), config.fsm, node.name)
+    for parent, _, plan in diff.added:
+        if parent.state in parent.fsm_config.fsm.ing_states:
+            # the new node would miss the command its siblings are busy with
+            errors.append(f"{parent.name} is busy with {parent.state}, {plan.path} can't be added now")
+        for leaf in [plan] if plan.leaf else _plan_leaves(plan):
+            missing(_leaf_class(leaf_class, leaf.template), leaf.fsm, leaf.path)
+    return errors
+
+
+def _plan_leaves(plan):
+    for child in plan.children:
+        if child.leaf:
+            yield child
+        else:
+            yield from _plan_leaves(child)
+
+
+def _set_config(node, config, live):
+    fsm_changed = config.fsm is not node.fsm_config.fsm
+    node.fsm_config = config
+    if live and fsm_changed:
+        # same state if the new FSM has it, otherwise it starts over
+        machine = _machine(config.fsm)
+        state = node.state
+        if state not in config.fsm.states or state in config.fsm.ing_states:
+            state = machine.initial
+        machine.set_state(state, model=node)
+        node.fsm = machine
+
+
+def reload(topnode, config:str, leaf_class=None, timeout=5., use_cache=True):
+    '''
+    Makes the tree below topnode match a new configuration (json string), which must
+    have the same top node. New leaves are leaf_class (ExecLeaf by default, or {template: class}, see simple.load)
+    The nodes that disappear are shut down, waiting at most timeout for them
+    Returns what changed, as lists of paths
+    '''
+    plan = _compile(config, use_cache)
+    if plan.name != topnode.name:
+        raise ConfigError([f"the top node can't change ({topnode.name} -> {plan.name})"])
+    live = topnode.fsm is not None # create_fsms() was called
+
+    diff = _Diff()
+    _diff_node(diff, topnode, plan, None, None)
+    _find_moves(diff)
+    # the moved nodes take their new parent's configuration, and may have changed inside
+    for node, parent, parent_plan, node_plan in diff.moved:
+        parent_config = diff.reconfigured.get(parent, parent.fsm_config)
+        if node_plan.leaf:
+            if parent_config is not node.fsm_config:
+                diff.reconfigured[node] = parent_config
+        else:
+            _diff_node(diff, node, node_plan, parent_plan, parent_config)
+
+    errors = _check(diff, leaf_class, live)
+    if errors:
+        raise ConfigError(errors)
+
+    console = topnode.console
+    for node, path in diff.removed.items():
+        console.log(f"Reload: removing {path}")
+        shutdown(node, timeout)
+        if metrics.registry is not None:
+            metrics.registry.forget(node)
+        node.parent = None
+    if diff.reconfigured:
+        console.log(f"Reload: reconfiguring {len(diff.reconfigured)} node(s)")
+    for node, config in diff.reconfigured.items():
+        _set_config(node, config, live)
+    for node, parent, _, node_plan in diff.moved:
+        console.log(f"Reload: moving {node.name} to {node_plan.path}")
+        node.parent = parent
+    catching_up = []
+    configs = {} # the nodes added from a range share their FSMConfig, see _construct_node
+    for parent, parent_plan, node_plan in diff.added:
+        console.log(f"Reload: adding {node_plan.path}")
+        node = _construct_node(node_plan, parent_plan, parent, console, leaf_class, configs=configs)
+        if live:
+            node._create_fsm()
+            if _catch_up(node, parent):
+                catching_up.append(node_plan.path)
+    for node, node_plan in diff.reordered.items():
+        if node.parent is None and node is not topnode:
+            continue
+        by_name = {child.name: child for child in node.children}
+        if list(by_name) != [p.name for p in node_plan.children]:
+            node.children = [by_name[p.name] for p in node_plan.children]
+    if live:
+        # new leaves with a heartbeat are watched, and the removed ones forgotten
+        _watch_liveness(topnode)
+
+    return {
+        "added": [node_plan.path for _, _, node_plan in diff.added],
+        "removed": list(diff.removed.values()),
+        "moved": [node_plan.path for _, _, _, node_plan in diff.moved],
+        "reconfigured": [node.name for node in diff.reconfigured],
+        "catching_up": catching_up,
+    }
+
+
+def _catch_up(node, parent):
+    ## A new node starts from its initial state: it goes through the transitions to its parent's
+    ## state on its own thread, so that it can take the parent's next command. Returns whether it has to
+    try:
+        steps = shortest_path(node.fsm_config.transitions, node.state, parent.state)
+    except ValueError:
+        # ex: the parent is on error, the new node stays where it is (and rejects what it can't do)
+        node.console.log(f"Reload: {node.name} can't get to {parent.state}, it stays {node.state}")
+        return False
+    if steps:
+        node.console.log(f"Reload: {node.name} goes through {steps} to catch up with {parent.name}")
+        node.send_command(("run_steps", steps))
+    return bool(steps)
@@ -0,0 +1,112 @@
+'''
+Printouts of the trees and of their FSMs, rich is only imported when something gets printed
+'''
+from anytree import RenderTree
+from rich.json import JSON
+from rich.table import Table
+
+
+def print_json(console, text):
+    console.print(JSON(text))
+
+
+def print_fsm(node, console, ing_suffix="_ing"):
+    ## Some helper function on the FSM, to printout what we are allowed to do
+
+    # If we are in between states, bail
+    if len(node.state)>4 and node.state[-4:] == ing_suffix:
+        node.console.print(f"Can't send command, node is {node.state}")
+        return
+    
+    table = Table(title=f"{node.name} commands")
+    table.add_column("Previous",justify='left')
+    table.add_column("Current",justify='center')
+    table.add_column("Next",justify='left')
+    transitions_in = []
+    transitions_out = []
+    now_state = node.state
+    for transition in node.fsm_config.transitions:
+        if transition['dest']   == now_state:
+            transitions_in .append(transition)
+        if transition['source'] == now_state:
+            transitions_out.append(transition)
+
+    n_t_in, n_t_out = len(transitions_in), len(transitions_out)
+    n_lines = max(n_t_in, n_t_out)
+
+    history = getattr(node, "_history", None)
+    if history is not None:
+        last = history.last_success()
+    elif node.last_successful_cmd and len(node.last_successful_cmd)>4 and node.last_successful_cmd[:4]=="end_":
+        last = node.last_successful_cmd[4:]
+    else:
+        last = node.last_successful_cmd
+
+    for i in range(n_lines):
+        text = []
+        if i<n_t_in:
+            # Highlights the last command that was executed
+            if transitions_in[i]["trigger"] == last:
+                ### Any way to make a better arrow?
+                text += ["[blue]"+transitions_in[i]["source"]+"[/blue]──[[green]"+transitions_in[i]["trigger"]+"[/green]]──>" ]
+            else:
+                text += ["[blue]"+transitions_in[i]["source"]+"[/blue]──\["+transitions_in[i]["trigger"]+"]──>" ]
+        else: 
+            text += ["", ""]
+
+        if i+1==int((n_lines+1)/2):
+            text += ["[magenta]"+now_state+"[/magenta]"]
+        else:
+            text += [""]
+
+        if i<n_t_out:
+            text += ["──\["+transitions_out[i]["trigger"]+"]──>[blue]"+transitions_out[i]["dest"]+"[/blue]"]
+        else: 
+            text += ["", ""]
+        table.add_row(*text)
+    console.print(table)
+
+
+def print_status(node, console):
+    ## Usual status
+    table = Table(title=f"apps")
+    table.add_column("name", style="blue")
+    table.add_column("state", style="green")
+
+    # all the states as they were at the same instant
+    snapshot = node.snapshot()
+    for pre, _, child in RenderTree(node):
+        state = snapshot.state(child)
+        if len(state)>3 and state[-4:] == "_ing":
+            state= "[yellow]"+state+"[/yellow]"
+        elif state == "error":
+            state= "[red bold]"+state+"[/red bold]"
+            
+        table.add_row(
+            pre+child.name,
+            state
+        )
+
+    console.print(table)
+
+
+def print_consistency(node, console):
+    ## Status with the consistency of the nodes, and whether they are included
+    table = Table(title=f"apps")
+    table.add_column("name", style="blue")
+    table.add_column("state", style="magenta")
+    table.add_column("consistent")
+    table.add_column("included", style="magenta")
+
+    for pre, _, child in RenderTree(node):
+        state = child.state if child.state[-3:] != "ing" else "[yellow]"+child.state+"[/yellow]"
+        error = "yes" if child.is_consistent() else "[red]no[/red]"
+        included = "yes" if child.fsm_config.included else "no"
+        table.add_row(
+            pre+child.name,
+            state,
+            error,
+            included
+        )
+
+    console.print(table)
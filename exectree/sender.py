@@ -0,0 +1,105 @@
+'''
+The threads executing the commands sent to the nodes, and how to stop them
+'''
+import threading
+import time
+import traceback
+from queue import SimpleQueue
+
+from anytree import PreOrderIter
+
+from . import metrics
+
+
+class CommandSender(threading.Thread):
+    '''
+    A class to send command to the node
+    '''
+    STOP="COMMAND_QUEUE_STOP"
+
+    def __init__(self, node):
+        threading.Thread.__init__(self, name=f"command_sender_{node.name}", daemon=True)
+        self.node = node
+        self.queue = SimpleQueue()
+        self.stopping = threading.Event()
+
+
+    def add_command(self, cmd):
+        self.queue.put(cmd)
+
+
+    def run(self):
+        while True:
+            command = self.queue.get()
+            if command == self.STOP or self.stopping.is_set():
+                # Whatever is left in the queue is dropped, we are going down
+                break
+            if command:
+                # a command with arguments comes as a tuple, ex: ("run_steps", ["boot", "init"])
+                args = ()
+                if isinstance(command, tuple):
+                    command, *args = command
+                cmd = getattr(self.node, command, None)
+                if not cmd:
+                    raise RuntimeError(f"ERROR: {self.node.name}: I don't know of '{command}'")
+                self.node.console.log(f"{self.node.name} Ack: executing '{command}'")
+                start = time.perf_counter()
+                status = "ok"
+                try:
+                    cmd(*args)
+                except Exception as e:
+                    ## Typically a command that isn't valid in the current state (a straggler
+                    ## that went on error for example), don't let the thread die over it
+                    self.node.console.log(f"{self.node.name} Couldn't execute '{command}':\n{traceback.format_exc()}")
+                    status = "rejected"
+                    # whoever sent it is told, rather than left waiting (see simple.ExecNode._command_rejected)
+                    rejected = getattr(self.node, "_command_rejected", None)
+                    if rejected is not None:
+                        rejected(command, e)
+                if metrics.registry is not None:
+                    labels = (("class", type(self.node).__name__), ("command", command))
+                    metrics.registry.inc("exectree_commands_total", labels+(("status", status),))
+                    metrics.registry.inc("exectree_command_seconds_total", labels, time.perf_counter()-start)
+                if status == "ok":
+                    self.node.console.log(f"{self.node.name} Finished '{command}'")
+
+
+    def signal_stop(self):
+        ## Non blocking, so that a whole tree can be signalled before anyone is joined
+        self.stopping.set()
+        self.queue.put_nowait(self.STOP)
+        # Also wake up the node if it is waiting for its children
+        status_receiver_queue = getattr(self.node, "status_receiver_queue", None)
+        if status_receiver_queue is not None:
+            status_receiver_queue.put_nowait(self.STOP)
+
+
+    def stop(self, timeout=None):
+        ## Returns whether the thread actually finished within the timeout
+        self.signal_stop()
+        self.join(timeout)
+        return not self.is_alive()
+
+
+def shutdown(topnode, timeout=5.):
+    '''
+    Stop the command senders of the whole tree below topnode
+    All the nodes are signalled first, then joined against a single deadline,
+    so a busy node costs at most timeout, and not timeout per node
+    Returns the list of nodes which didn't stop in time
+    '''
+    # Nodes that never received a command don't have a thread to stop
+    nodes = [node for node in PreOrderIter(topnode) if node._command_sender is not None]
+    for node in nodes:
+        node.command_sender.signal_stop()
+
+    deadline = time.monotonic() + timeout
+    stuck = []
+    for node in nodes:
+        node.command_sender.join(max(0., deadline - time.monotonic()))
+        if node.command_sender.is_alive():
+            stuck.append(node)
+
+    if stuck:
+        topnode.console.log(f"{len(stuck)} node(s) didn't stop after {timeout}s: {[node.name for node in stuck]}")
+    return stuck
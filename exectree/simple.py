@@ -0,0 +1,1141 @@
+from anytree import LightNodeMixin, RenderTree, PreOrderIter
+from functools import partial
+import traceback
+import json
+from transitions import Machine
+import threading
+from queue import SimpleQueue, Empty
+import time
+import math
+import sys
+import gc
+import types
+
+from . import metrics
+from .history import History
+from .snapshot import StateTable
+from .sender import CommandSender, shutdown
+from .plan import ConfigError, compile_config, derive_fsm, shortest_path
+
+class FSMConfig():
+    '''
+    A class that holds all the FSM configuration stored on each node
+    Nodes that don't specify anything share their parent's one
+    '''
+    __slots__ = ["config_json", "included", "tags", "transitions", "states", "transition_conf", "fan_in_policy", "retry",
+                 "timeouts", "barriers", "heartbeat", "fsm"]
+
+    def __init__(self, config_json):
+        self.config_json = config_json
+        self.included = config_json.get("included")
+        # inherited like the rest, a tag on a node applies to everything below it
+        self.tags = frozenset(config_json.get("tags", ()))
+        self.transitions = config_json.get("transitions")
+        self.states = config_json.get("states")
+        self.transition_conf = config_json.get("transition-conf")
+        self.fan_in_policy = fan_in_policy(self.transition_conf)
+        self.retry = {
+            transition["trigger"]: RetryConfig(transition["retry"])
+            for transition in self.transitions or [] if "retry" in transition
+        }
+        # how long the user code of the leaves has for each transition, no limit if not there
+        self.timeouts = {
+            transition["trigger"]: transition["timeout"]
+            for transition in self.transitions or [] if "timeout" in transition
+        }
+        # where run_to waits for the whole tree before going on
+        self.barriers = frozenset(
+            transition["trigger"] for transition in self.transitions or [] if transition.get("barrier")
+        )
+        # how the leaves are checked between commands, see liveness.py
+        self.heartbeat = config_json.get("heartbeat")
+        # the states and transitions of the machine, derived once for each distinct configuration
+        self.fsm = derive_fsm(self.states, self.transitions, config_json.get("initial"))
+
+
+class RetryConfig():
+    '''
+    How many times a leaf tries its user code for a transition, and how long it waits in between
+    Configured per transition, for example:
+      {"trigger": "boot", ..., "retry": {"attempts": 3, "backoff": 0.5, "factor": 2, "on": ["ConnectionError"]}}
+    "on" lists the names of the exceptions worth retrying (subclasses included), any exception if omitted
+    '''
+    def __init__(self, retry_json):
+        self.attempts = retry_json.get("attempts", 1)
+        self.backoff = retry_json.get("backoff", 0.)
+        self.factor = retry_json.get("factor", 2.)
+        self.max_backoff = retry_json.get("max-backoff", 30.)
+        self.retry_on = retry_json.get("on")
+
+    def is_retryable(self, exception):
+        if self.retry_on is None:
+            return True
+        return any(klass.__name__ in self.retry_on for klass in type(exception).__mro__)
+
+    def delay(self, n_failed):
+        return min(self.backoff * self.factor**(n_failed-1), self.max_backoff)
+
+
+NO_RETRY = RetryConfig({})
+
+
+class CallbackTimeout(TimeoutError):
+    '''
+    The user code of a leaf took longer than the "timeout" of its transition
+    It's left to finish on its own, whatever it does after that is ignored
+    '''
+
+
+# leaf -> how many of its workers are still running after their budget was over, only while there are
+# A retried overrun doesn't stop the late worker: past that many, the leaf fails without starting another one
+MAX_LATE_WORKERS = 1
+_late_workers = {}
+_late_workers_lock = threading.Lock()
+
+
+def _run_user_code(cls, user_code, budget):
+    ## Without budget, on the node's thread as it always was. With one, on a worker thread, so that
+    ## the node's thread is free again when the budget is over, whatever the user code is up to
+    if budget is None:
+        user_code()
+        return
+
+    if _late_workers.get(cls, 0) >= MAX_LATE_WORKERS:
+        raise CallbackTimeout(f"{cls.name} is still busy with an earlier {cls.state} that went over its budget")
+
+    outcome = []
+    late = []
+    def work():
+        try:
+            user_code()
+        except BaseException as e:
+            outcome.append(e)
+        else:
+            outcome.append(None)
+        with _late_workers_lock:
+            if late:
+                n = _late_workers.pop(cls) - 1
+                if n:
+                    _late_workers[cls] = n
+
+    worker = threading.Thread(target=work, name=f"user_code_{cls.name}_{cls.state}", daemon=True)
+    worker.start()
+    worker.join(budget)
+    with _late_workers_lock:
+        if not outcome:
+            late.append(True)
+            _late_workers[cls] = _late_workers.get(cls, 0) + 1
+    if late:
+        raise CallbackTimeout(f"{cls.name} was still busy with {cls.state} after {budget}s")
+    if outcome[0] is not None:
+        raise outcome[0]
+
+
+class FailFast():
+    '''
+    "strict" transitions: the node fails as soon as one child fails
+    Latency on failure is the one of the first failing child
+    '''
+    name = "fail-fast"
+
+    def verdict(self, n_children, n_success, n_failed):
+        if n_failed > 0:
+            return "failed"
+        if n_success == n_children:
+            return "success"
+        return None
+
+
+class WaitAll():
+    '''
+    "complaisant" transitions: every child gets to finish (or time out) before deciding,
+    the node fails if any of them failed, but the siblings that succeeded are left alone
+    Latency is the one of the slowest child
+    '''
+    name = "wait-all"
+
+    def verdict(self, n_children, n_success, n_failed):
+        if n_success + n_failed < n_children:
+            return None
+        return "success" if n_failed == 0 else "failed"
+
+
+class Quorum():
+    '''
+    "quorum=N" or "quorum=N%" transitions: the node succeeds as soon as N children
+    (or N% of them) succeeded, and fails as soon as that isn't reachable anymore
+    Latency is the one of the N-th fastest child, the stragglers carry on in the background
+    '''
+    name = "quorum"
+
+    def __init__(self, count=None, fraction=None):
+        self.count = count
+        self.fraction = fraction
+
+    def needed(self, n_children):
+        if self.count is not None:
+            return min(self.count, n_children)
+        return math.ceil(self.fraction * n_children)
+
+    def verdict(self, n_children, n_success, n_failed):
+        needed = self.needed(n_children)
+        if n_success >= needed:
+            return "success"
+        if n_children - n_failed < needed:
+            return "failed"
+        return None
+
+
+def fan_in_policy(transition_conf):
+    '''
+    Find out from the "transition-conf" string (ex: "strict,long") how a node decides
+    that its children are done with a transition. Unknown keywords are left to other parsers
+    '''
+    if not transition_conf:
+        return FailFast()
+
+    for word in transition_conf.split(","):
+        word = word.strip()
+        if word in ["strict", "fail-fast"]:
+            return FailFast()
+        if word in ["complaisant", "wait-all"]:
+            return WaitAll()
+        if word.startswith("quorum="):
+            value = word[len("quorum="):]
+            try:
+                if value.endswith("%"):
+                    return Quorum(fraction=float(value[:-1])/100.)
+                return Quorum(count=int(value))
+            except ValueError as e:
+                raise ValueError(f"Can't understand \"{word}\" in transition-conf, expected quorum=N or quorum=N%") from e
+
+    return FailFast()
+
+
+class ExecNode(LightNodeMixin):
+    '''
+    A node that is just sending commands to its children nodes
+    Nodes are slotted, and the FSM machinery (triggers, callbacks) lives on the classes and on
+    a machine shared by all the nodes with the same FSM, so huge trees stay lean.
+    Subclasses that don't declare __slots__ simply get a __dict__ back.
+    '''
+    __slots__ = ["console", "name", "_command_sender", "status_receiver_queue", "last_successful_cmd",
+                 "fsm_config", "fsm", "event", "_state", "_history", "_table", "_index", "_error"]
+    _command_sender_lock = threading.Lock()
+
+    def __init__(self, name:str,
+                 fsm_config=None, parent=None, children=None, console=None):
+        self.console = console
+        self.name = name
+        self.fsm = None
+        self.event = None
+        self.last_successful_cmd = None
+        # the last transitions, allocated with the first one (see history.py)
+        self._history = None
+        # the message it last went on error with, so that nobody has to carry the details up (see _report)
+        self._error = None
+        # Only nodes with children need one, it's created when the first child is attached
+        self.status_receiver_queue = None
+        # The thread is only created when the node receives its first command
+        self._command_sender = None
+        # where the node writes its state, for the snapshots of the whole tree (see snapshot.py)
+        self._table = parent._table if parent is not None else StateTable()
+        self._index = self._table.register(self)
+        self.parent = parent
+        if children:
+            self.children = children
+        try:
+            if isinstance(fsm_config, FSMConfig):
+                # already made for a sibling with the same configuration (see _construct_node)
+                self.fsm_config = fsm_config
+            elif parent is not None and (not fsm_config or fsm_config is parent.fsm_config.config_json):
+                self.fsm_config = parent.fsm_config
+            elif parent is not None:
+                # Whatever isn't specified on this node is inherited from the parent
+                self.fsm_config = FSMConfig({**parent.fsm_config.config_json, **fsm_config})
+            else:
+                self.fsm_config = FSMConfig(fsm_config)
+        except Exception as e:
+            raise KeyError(f"{self.name} hasn't been specified a proper configuration for FSM (need states and transitions)") from e
+
+
+    @property
+    def command_sender(self):
+        if self._command_sender is None:
+            with self._command_sender_lock:
+                if self._command_sender is None:
+                    command_sender = CommandSender(self)
+                    command_sender.start()
+                    self._command_sender = command_sender
+        return self._command_sender
+
+
+    def _post_attach(self, parent):
+        if parent.status_receiver_queue is None:
+            parent.status_receiver_queue = SimpleQueue()
+        if self._table is not parent._table:
+            # built on its own, or back in the tree (moved by a reload): it joins its parent's table
+            parent._table.adopt(self)
+
+
+    def _post_detach(self, parent):
+        # its index goes to the next node of the tree, it takes its states with it
+        StateTable().adopt(self)
+
+
+    @property
+    def state(self):
+        return self._state
+
+
+    @state.setter
+    def state(self, state):
+        ## Set by the machine, the table has it as soon as the node does
+        self._state = state
+        self._table.set(self._index, state)
+
+
+    def __getattr__(self, name):
+        ## Only called when the attribute isn't found on the node or its class:
+        ## the triggers (boot, end_boot, to_error...) and is_<state> are looked up on the shared machine
+        if name.startswith("_"):
+            raise AttributeError(name)
+        machine = self.fsm
+        if machine is not None:
+            event = machine.events.get(name)
+            if event is not None:
+                return partial(event.trigger, self)
+            if name.startswith("is_") and name[3:] in machine.states:
+                return partial(machine.is_state, name[3:], self)
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+
+    def create_fsms(self):
+        ## Has to be called once the leaves have their final class, as that's when
+        ## we can check that they have all the user_on_enter_* they need
+        missing = _missing_callbacks(self)
+        if missing:
+            raise ConfigError(missing)
+        self._create_fsm()
+        _watch_liveness(self)
+
+
+    def _create_fsm(self):
+        self.fsm = FSMFactory(self, self.fsm_config)
+        if self.children:
+            for child in self.children:
+                child._create_fsm()
+
+
+    def _on_enter_ing(self, event):
+        _transition_with_interm(self, event)
+
+
+    def _on_exit_ing(self, event):
+        _on_exit(self, event)
+
+
+    def on_enter_error(self, eventdata):
+        message = eventdata.args[0]
+        self._error = message
+        if not self.parent:
+            # Wayyy to lazy to extract the stack trace from that,
+            # but that could be done
+            from . import render
+            render.print_json(self.console, message)
+
+
+    def _command_rejected(self, command, e):
+        ## A trigger the node can't take in its state: the parent (and run_to, multicast) hear it
+        ## as a failure of this node, rather than waiting for it until they time out
+        if self.fsm is None or command not in self.fsm.events or command.startswith("end_"):
+            return
+        message = json.dumps({
+            "status": "rejected",
+            "node": self.name,
+            "state": self.state,
+            "trigger": command,
+            "exception": f"{type(e).__name__}: {e}",
+        })
+        if self.parent:
+            self.parent.status_receiver_queue.put(message)
+        for waiter in _waiters.get(self, ()):
+            waiter.put((self, message))
+
+
+    def _clock(self):
+        ## What the history is timed with
+        return time.time()
+
+
+    def _set_environment(self, event):
+        ## A callback before the transition is executed
+        ## So that we know which command has been sent in the on_enter_* method
+        self.event = event
+
+
+    def quit(self, timeout=5.):
+        ## Somehow I can't move this to the __del__?
+        ## I don't know how to delete an anytree properly
+        ## Returns the nodes that didn't stop within the timeout
+        self.console.log(f"Killing me softly... {self.name}")
+        if "exectree.liveness" in sys.modules:
+            sys.modules["exectree.liveness"].unwatch(self)
+        stuck = shutdown(self, timeout)
+        if metrics.registry is not None:
+            metrics.registry.forget(self)
+        return stuck
+
+
+    def reload(self, config:str, leaf_class=None, timeout=5., use_cache=True):
+        ## Applies a new configuration (json string) to the running tree, see reconfig.py
+        from . import reconfig
+        return reconfig.reload(self, config, leaf_class, timeout, use_cache)
+
+
+    def select(self, path=None, state=None, tag=None):
+        ## The nodes below this one matching all the criteria, see multicast.py
+        from . import multicast
+        return multicast.select(self, path, state, tag)
+
+
+    def multicast(self, command, path=None, state=None, tag=None, timeout=15.):
+        ## Sends the command to the selected nodes, and waits for them, see multicast.py
+        from . import multicast
+        return multicast.multicast(self, command, path, state, tag, timeout)
+
+
+    def run_steps(self, steps, handed_by=None):
+        ## Goes through the transitions one after the other, see _run_steps
+        _run_steps(self, steps, handed_by)
+
+
+    def run_to(self, target, timeout=None):
+        '''
+        Takes the node (and everything below it) to the target state, by the shortest way allowed by its transitions
+        The children get all the steps at once and go through them at their own pace, they are only
+        waited for at the transitions declared with "barrier": true (and at the end)
+        Waits at most timeout (FAN_IN_TIMEOUT and RUN_TO_MARGIN per step by default), returns a summary
+        '''
+        steps = shortest_path(self.fsm_config.transitions, self.state, target)
+        if not steps:
+            return {"steps": [], "status": "success", "state": self.state, "elapsed": 0.}
+        timeout = (FAN_IN_TIMEOUT+RUN_TO_MARGIN)*len(steps) if timeout is None else timeout
+
+        waiter = SimpleQueue()
+        _add_waiter(self, waiter)
+        start = time.monotonic()
+        status = "timeout"
+        try:
+            self.send_command(("run_steps", steps))
+            deadline = start + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    _, message = waiter.get(timeout=remaining)
+                except Empty:
+                    break
+                response = json.loads(message)
+                if response.get("status") != "success":
+                    status = "failed"
+                    break
+                if response.get("trigger") == steps[-1]:
+                    status = "success"
+                    break
+        finally:
+            _remove_waiter(self, waiter)
+        return {"steps": steps, "status": status, "state": self.state, "elapsed": time.monotonic()-start}
+
+
+    def error_details(self, path=None, state=None, tag=None):
+        ## {path: the message} of the selected nodes (see select) that went on error, the last time they did,
+        ## in full: the statuses going up only have a summary of what failed (see _report)
+        from . import multicast
+        return {node_path: json.loads(node._error) for node_path, node in multicast.select(self, path, state, tag)
+                if node._error is not None}
+
+
+    def history(self, trigger=None, path=None, state=None, tag=None, within=None, outcome=None, slowest=None):
+        ## The last transitions of the selected nodes, ex: the 20 slowest conf in the last hour, see history.py
+        from . import history
+        return history.query(self, trigger, path, state, tag, within, outcome, slowest)
+
+
+    def profile(self, path=None, interval=None, per_node=True):
+        ## A with block in which the threads of the nodes below this one are sampled, see profiler.py
+        from . import profiler
+        return profiler.profile(self, path, interval, per_node)
+
+
+    def export_graphs(self, directory, format="dot"):
+        ## One diagram per distinct FSM and one of the tree with the states counted, see graph.py
+        from . import graph
+        return graph.export(self, directory, format)
+
+
+    def print_fsm(self, console=None):
+        ## Some helper function on the FSM, to printout what we are allowed to do
+        from . import render
+        render.print_fsm(self, console)
+
+
+    def print_status(self, console=None):
+        ## Usual status
+        from . import render
+        render.print_status(self, console)
+
+    def snapshot(self):
+        ## The states of the whole tree this node is in, all as they were at the same instant, see snapshot.py
+        return self._table.snapshot(self._clock)
+
+
+    def is_consistent(self):
+        ## Fills the consistent flag (are my children in the same state as me?)
+        ## From a snapshot: the states read while the tree keeps moving wouldn't be of the same instant
+        return self.snapshot().is_consistent(self)
+
+    def send_command(self, command):
+        ## Use the command_sender to send commands
+        self.command_sender.add_command(command)
+
+
+class ExecLeaf(ExecNode):
+    '''
+    A node that is can execute command, it can't have children, these are applications
+    '''
+    __slots__ = []
+
+    def __init__(self, name:str, parent=None, fsm_config=None, console=None):
+        super().__init__(name=name, parent=parent, fsm_config=fsm_config, console=console)
+        
+    def is_consistent(self):
+        ## Since I can't have children, I'm always consistent
+        return True
+
+    def _on_enter_ing(self, event):
+        _on_enter(self, event)
+
+    def heartbeat(self):
+        ## For the application to say it's alive, when it has a heartbeat but no user_health_check, see liveness.py
+        from . import liveness
+        liveness.beat(self)
+
+
+def _leaf_class(leaf_class, template):
+    ## leaf_class is a class, or {template: class} with the class of the other templates under None
+    if isinstance(leaf_class, dict):
+        return leaf_class.get(template) or leaf_class.get(None) or ExecLeaf
+    return leaf_class or ExecLeaf
+
+
+def _construct_tree(plan, mother, console, leaf_class=None, node_class=None, configs=None):
+    ## Typical tree creation recursive function.
+    ## All the leafs (without children) are ExecLeafs (or leaf_class, see _leaf_class), the others ExecNodes (or node_class)
+    ## configs: id(plan.config) -> the FSMConfig made for it, the nodes of a range compile to the same plan.config
+    if configs is None:
+        configs = {}
+    for child_plan in plan.children:
+        _construct_node(child_plan, plan, mother, console, leaf_class, node_class, configs)
+
+
+def _construct_node(plan, parent_plan, mother, console, leaf_class=None, node_class=None, configs=None):
+    if plan.leaf:
+        return _leaf_class(leaf_class, plan.template)(name=plan.name, parent=mother, fsm_config=None, console=console)
+    if configs is None:
+        configs = {}
+    # None: shares the parent's FSMConfig, when the node doesn't specify anything
+    # otherwise the one of the first node with that configuration (package[1-4] make one FSMConfig)
+    fsm_config = None if plan.config is parent_plan.config else configs.get(id(plan.config), plan.config)
+    node = (node_class or ExecNode)(name=plan.name, parent=mother, fsm_config=fsm_config, console=console)
+    configs[id(plan.config)] = node.fsm_config
+    _construct_tree(plan, node, console, leaf_class, node_class, configs)
+    return node
+
+
+def _missing_callbacks(topnode):
+    ## The user callbacks that the leaves below topnode don't define, once per leaf class
+    missing = []
+    checked = set()
+    for node in PreOrderIter(topnode):
+        if not isinstance(node, ExecLeaf) or (type(node), node.fsm_config.fsm) in checked:
+            continue
+        checked.add((type(node), node.fsm_config.fsm))
+        for callback in node.fsm_config.fsm.user_callbacks:
+            if not callable(getattr(node, callback, None)):
+                missing.append(f"{node.name} ({type(node).__name__}) doesn't define {callback}")
+    return missing
+
+
+def _watch_liveness(topnode):
+    ## The liveness thread is only started if a leaf has a heartbeat, or to forget those that don't anymore
+    if "exectree.liveness" in sys.modules or any(node.fsm_config.heartbeat for node in PreOrderIter(topnode)):
+        from . import liveness
+        liveness.watch(topnode)
+
+
+def load(config:dict, console, use_cache=True, cache_dir=None, leaf_class=None):
+    '''
+    Load json string to the full blown tree+fsms, the leaves are leaf_class (ExecLeaf by default)
+    leaf_class can also be {template: class}: a leaf is the class of its value in the configuration
+    ("wib[1-480]": "wib" -> leaf_class["wib"]), leaf_class[None] (or ExecLeaf) if it isn't there
+    The configuration is compiled first, so that any mistake in it is reported here (see plan.py)
+    The compiled plan is cached on disk (see cache.py), unless use_cache is False
+    '''
+    plan = _compile(config, use_cache, cache_dir)
+
+    console.log(f"Creating topnode {plan.name}")
+    topnode = ExecNode(name=plan.name, fsm_config=plan.config, console=console)
+    console.log(f"Constructing tree from {plan.name}")
+    _construct_tree(plan, topnode, console, leaf_class)
+
+    # A bit of useful printout for debugging
+    for pre, _, node in RenderTree(topnode):
+        console.print(f"{pre}{node.name}")
+
+    return topnode
+
+
+def _compile(config, use_cache=True, cache_dir=None):
+    if use_cache:
+        from .cache import compile_cached
+        return compile_cached(config, cache_dir)
+    return compile_config(json.loads(config))
+
+
+def loads(in_file:str, console, use_cache=True, cache_dir=None, leaf_class=None):
+    '''
+    Load json file to the full blown tree+fsms
+    '''
+    config = open(in_file, "r").read()
+    return load(config, console, use_cache, cache_dir, leaf_class)
+
+
+# how long a node waits for its children
+FAN_IN_TIMEOUT = 15 ## TODO: specify timeout in cfg
+# what run_to waits on top of that, so that it gets the tree's own verdict (the timeouts of the children
+# and the levels below) rather than giving up at the same time as the tree does
+RUN_TO_MARGIN = 5.
+
+
+class FanIn():
+    '''
+    Where a node is at with its children, during a transition
+    The waiting itself is left to the caller: a thread here, the virtual clock in simulation.py
+    '''
+    __slots__ = ["trigger", "still_to_exec", "n_children", "n_success", "failed", "verdict", "start"]
+
+    def __init__(self, trigger, start):
+        self.trigger = trigger
+        self.still_to_exec = {} # a record of which children still need to finish their task
+        self.n_children = 0
+        self.n_success = 0
+        self.failed = []
+        self.verdict = None
+        self.start = start
+
+
+def _fan_in_start(cls, trigger, now):
+    ## Sends the command to the children, unless they already have it (run_steps), in which case
+    ## they may even have answered
+    fan_in = FanIn(trigger, now)
+    sequence = _sequences.get(cls)
+    for child in cls.children:
+        fan_in.still_to_exec[child.name] = child
+        if sequence is None:
+            cls.console.log(f"{cls.name} is sending '{trigger}' to {child.name}")
+
+            ## TODO add order here!!
+            child.send_command(trigger) # send the commands
+    fan_in.n_children = len(fan_in.still_to_exec)
+    if sequence is not None:
+        for m in sequence.early.pop(trigger, ()):
+            _fan_in_receive(cls, fan_in, m)
+    return fan_in
+
+
+def _fan_in_receive(cls, fan_in, m):
+    ## A message from a child, returns the verdict of the fan-in policy (None: not yet)
+    response = json.loads(m)
+    if response.get("trigger") != fan_in.trigger or not response["node"] in fan_in.still_to_exec:
+        return fan_in.verdict
+    del fan_in.still_to_exec[response["node"]]
+
+    if response["status"] != "success":
+        fan_in.failed.append(response)
+    else:
+        fan_in.n_success += 1
+    fan_in.verdict = cls.fsm_config.fan_in_policy.verdict(fan_in.n_children, fan_in.n_success, len(fan_in.failed))
+    return fan_in.verdict
+
+
+def _fan_in_finish(cls, fan_in, now):
+    ## The verdict is in (or the time is up): the stragglers go on error, and so does the node if it failed
+    verdict = fan_in.verdict
+    failed = fan_in.failed
+    timeout = []
+    if verdict != "success" and len(fan_in.still_to_exec) > 0:
+        # If the policy is happy, the stragglers are left to finish on their own
+        cls.console.log(f"Sh*t the f*n... {cls.name} can't {fan_in.trigger} {list(fan_in.still_to_exec.keys())}")
+        timeout = list(fan_in.still_to_exec.values())
+        for node in timeout:
+            d = {
+                "state": cls.state,
+                "trigger": cls.event.event.name,
+                "node": node.name,
+                "failed": "",
+                "status": "Timed out after waiting for too long, or because a sibling went on error",
+            }
+            node.to_error(json.dumps(d))
+
+    status = "success"
+    if verdict != "success":
+        if len(timeout)>0:
+            status = "timeout"
+        if len(failed)>0:
+            status = "failed"
+
+    timeout = [c.name for c in timeout]
+    for fail in failed[:MAX_FAILED]:
+        cls.console.log(f"Sh*t the f*n... {fail['node']} threw an error {fail['trigger']}")
+    if len(failed) > MAX_FAILED:
+        cls.console.log(f"Sh*t the f*n... and {len(failed)-MAX_FAILED} more children of {cls.name}")
+
+    if metrics.registry is not None:
+        labels = (("class", type(cls).__name__), ("trigger", fan_in.trigger))
+        metrics.registry.observe("exectree_fan_in_seconds", labels, now-fan_in.start)
+        metrics.registry.inc("exectree_transitions_total", labels+(("status", status),))
+        
+    text = json.dumps(_report(cls, cls.event.event.name, failed, timeout, status))
+
+    if status != "success":
+        cls.to_error(text)
+        return
+    
+    # Initiate the transition on this node to say that we have finished
+    finalisor = getattr(cls, "end_"+cls.event.event.name, None)
+    finalisor(text)
+
+
+# What a node reports of its children's failures, the rest is in the _error of each of them
+MAX_FAILED = 20 # children listed in "failed" and "timeout"
+MAX_GROUPS = 10 # distinct errors in "errors"
+MAX_SAMPLES = 5 # nodes named for each of them
+# the fields of a failed child that are repeated in its parent's "failed"
+SUMMARY_KEYS = ("node", "state", "trigger", "status", "exception", "n_failed", "n_timeout")
+
+
+def _report(cls, trigger, failed, timeout, status):
+    '''
+    The status of a node after its children's transition. The failures and timeouts of the whole
+    subtree are grouped by error in "errors", counted and with a few of the nodes, the stack of each
+    error being there once. Only the first MAX_FAILED failed and timed out children are listed
+    '''
+    d = {
+        "state": cls.state,
+        "trigger": trigger,
+        "node": cls.name,
+        "policy": cls.fsm_config.fan_in_policy.name,
+        "timeout": ",".join(timeout),
+        "failed": failed,
+        "status": status,
+    }
+    if not failed and not timeout:
+        return d
+
+    groups = {}
+    def add(group, count, nodes):
+        key = (group.get("status"), group.get("trigger"), group.get("exception"))
+        mine = groups.get(key)
+        if mine is None:
+            mine = groups[key] = {k: group[k] for k in ("status", "trigger", "exception", "stack") if k in group}
+            mine["count"] = 0
+            mine["nodes"] = []
+        mine["count"] += count
+        mine["nodes"].extend(nodes[:MAX_SAMPLES-len(mine["nodes"])])
+
+    other = 0
+    if timeout:
+        add({"status": "timeout", "trigger": trigger}, len(timeout), timeout)
+    for fail in failed:
+        if "errors" in fail:
+            for group in fail["errors"]:
+                add(group, group["count"], group["nodes"])
+            other += fail.get("other_errors", 0)
+        else:
+            add(fail, 1, [fail["node"]])
+    groups = sorted(groups.values(), key=lambda group: group["count"], reverse=True)
+    other += sum(group["count"] for group in groups[MAX_GROUPS:])
+
+    d["timeout"] = ",".join(timeout[:MAX_FAILED])
+    d["n_timeout"] = len(timeout)
+    d["failed"] = [{k: fail[k] for k in SUMMARY_KEYS if k in fail} for fail in failed[:MAX_FAILED]]
+    d["n_failed"] = len(failed)
+    d["errors"] = groups[:MAX_GROUPS]
+    if other:
+        d["other_errors"] = other
+    return d
+
+
+def _transition_with_interm(cls, _):
+    '''
+    An internal function that is used in ExecNode, when the transition take some time
+    '''
+    trigger = cls.event.event.name # command name
+
+    if len(trigger)>=4 and trigger[0:4] == "end_":
+        return
+
+    if not cls.children: # "that should never happen"
+        raise RuntimeError(f"{cls.name} doesn't have children to send commands to")
+
+    if cls not in _sequences:
+        _drain(cls)
+
+    fan_in = _fan_in_start(cls, trigger, time.monotonic())
+    deadline = fan_in.start + FAN_IN_TIMEOUT
+
+    while fan_in.verdict is None:
+        # once the time is up, what already arrived still counts
+        remaining = max(deadline - time.monotonic(), 0)
+        try:
+            m = cls.status_receiver_queue.get(timeout=remaining)
+        except Empty:
+            break
+
+        if m == CommandSender.STOP:
+            # The tree is being shut down, don't bother with the bookkeeping
+            return
+
+        if not _keep_for_later(cls, trigger, m):
+            _fan_in_receive(cls, fan_in, m)
+
+    _fan_in_finish(cls, fan_in, time.monotonic())
+
+
+def _drain(cls):
+    # Anything left over from a previous transition (stragglers, timed out children) is stale
+    while not cls.status_receiver_queue.empty():
+        cls.status_receiver_queue.get_nowait()
+
+
+class Sequence():
+    '''
+    Steps a node with children goes through in one go (see ExecNode.run_to): its children already have
+    all of them, the replies to the steps the node hasn't got to yet are kept until it does
+    '''
+    __slots__ = ["steps", "early", "over"]
+
+    def __init__(self, steps):
+        self.steps = steps
+        self.early = {} # trigger -> messages
+        self.over = False # the node stopped following its children, they stop too
+
+
+# node -> Sequence, while it runs steps
+_sequences = {}
+
+
+def _segments(cls, steps):
+    ## The steps, split before each barrier
+    segments = [[]]
+    for step in steps:
+        if step in cls.fsm_config.barriers and segments[-1]:
+            segments.append([])
+        segments[-1].append(step)
+    return segments
+
+
+def _sequence_start(cls, segment):
+    ## Hands the whole segment to the children
+    _drain(cls)
+    _sequences[cls] = sequence = Sequence(segment)
+    for child in cls.children:
+        cls.console.log(f"{cls.name} is sending {segment} to {child.name}")
+        child.send_command(("run_steps", segment, sequence))
+
+
+def _sequence_end(cls):
+    sequence = _sequences.pop(cls, None)
+    if sequence is not None:
+        sequence.over = True
+
+
+def _keep_for_later(cls, trigger, m):
+    ## A reply to a step still to come, returns whether it was kept
+    sequence = _sequences.get(cls)
+    if sequence is None:
+        return False
+    other = json.loads(m).get("trigger")
+    if other == trigger or other not in sequence.steps:
+        return False
+    sequence.early.setdefault(other, []).append(m)
+    return True
+
+
+def _run_steps(cls, steps, handed_by=None):
+    '''
+    Goes through the transitions one after the other on the node's thread, without giving the tree a chance
+    to settle in between: a node with children hands them a whole segment (the steps up to the next barrier)
+    and follows them, so a quick branch isn't held back by a slow one until the barrier
+    Stops at the first step that fails, or when handed_by (the parent's Sequence) is over
+    '''
+    for segment in _segments(cls, steps):
+        if cls.children:
+            _sequence_start(cls, segment)
+        try:
+            for step in segment:
+                if handed_by is not None and handed_by.over:
+                    return
+                try:
+                    getattr(cls, step)()
+                except Exception as e:
+                    cls._command_rejected(step, e)
+                    raise
+                if cls.state == "error" or cls.command_sender.stopping.is_set():
+                    return
+        finally:
+            _sequence_end(cls)
+
+
+def _on_enter(cls, _):
+    # create_fsms already checked that it's there
+    user_code = getattr(cls, "user_on_enter_"+cls.state)
+
+    retry = cls.fsm_config.retry.get(cls.event.event.name, NO_RETRY)
+    budget = cls.fsm_config.timeouts.get(cls.event.event.name)
+    attempts = []
+    while True:
+        start = time.time()
+        try:
+            _run_user_code(cls, user_code, budget)
+        except Exception as e:
+            attempts.append(_attempt(len(attempts)+1, start, time.time()-start, e))
+            # Back off on this node's own thread, the parent just keeps waiting on its queue
+            # The wait returns True if the tree is being shut down, in which case we give up
+            if len(attempts) < retry.attempts and retry.is_retryable(e) and \
+               not cls.command_sender.stopping.wait(retry.delay(len(attempts))):
+                cls.console.log(f"{cls.name} attempt {len(attempts)} at {cls.state} failed ({e}), retrying")
+                continue
+
+            _user_code_failed(cls, attempts, e, traceback.format_exc())
+            return
+
+        attempts.append(_attempt(len(attempts)+1, start, time.time()-start))
+        break
+
+    _user_code_succeeded(cls, attempts)
+
+
+def _attempt(number, start, duration, exception=None):
+    attempt = {
+        "attempt": number,
+        "start": start,
+        "duration": duration,
+        "status": "success" if exception is None else "failed",
+    }
+    if exception is not None:
+        attempt["exception"] = f"{type(exception).__name__}: {exception}"
+    return attempt
+
+
+def _user_code_failed(cls, attempts, e, stack):
+    ## No more attempts, the leaf goes on error
+    if metrics.registry is not None:
+        _user_code_metrics(cls, attempts, "timeout" if isinstance(e, CallbackTimeout) else "failed")
+    text = json.dumps({
+        "status": "timeout" if isinstance(e, CallbackTimeout) else "error running user code",
+        "node": cls.name,
+        "state": cls.state,
+        "trigger": cls.event.event.name,
+        "exception": str(e),
+        "stack": stack,
+        "attempts": attempts,
+    })
+    ### ARGGGG what if the node is already in a error?
+    ## This isn't a transition anymore...
+    ## The details are kept in the node's _error (see on_enter_error), a thousand leaves failing together
+    ## would otherwise print a thousand stacks
+    cls.console.log(f"{cls.name} failed {cls.state}: {e}")
+    ## ... put the node in error anyway
+    cls.to_error(text)
+
+
+def _user_code_succeeded(cls, attempts):
+    text = json.dumps({
+        "status": "success",
+        "node": cls.name,
+        "state": cls.state,
+        "trigger": cls.event.event.name,
+        "attempts": attempts,
+    })
+    
+    if metrics.registry is not None:
+        _user_code_metrics(cls, attempts, "success")
+    finish_up = getattr(cls, "end_"+cls.event.event.name, None)
+
+    try:
+        finish_up(text)
+    except Exception as e:
+        ## Same story here, one line: a fail-fast parent puts a thousand stragglers on error at once
+        cls.console.log(f"{cls.name} couldn't terminate {cls.event.event.name} in {cls.state}: {e}")
+        if cls.state == "error":
+            # put there by its parent (timeout, failed sibling): that's the error worth keeping
+            return
+        text = json.dumps({
+            "status": "Couldn't terminate command \""+cls.event.event.name+"\" the node probably was on error state",
+            "node": cls.name,
+            "exception": str(e),
+            "state": cls.state,
+            "trigger": cls.event.event.name,
+        })
+        cls.to_error(text)
+
+
+def _user_code_metrics(cls, attempts, status):
+    labels = (("class", type(cls).__name__), ("trigger", cls.event.event.name))
+    for attempt in attempts:
+        metrics.registry.observe("exectree_user_code_seconds", labels, attempt["duration"])
+    metrics.registry.inc("exectree_transitions_total", labels+(("status", status),))
+
+
+def _on_exit(cls, eventdata):
+    '''
+    This one is an automated callback
+    '''
+    message = eventdata.args[0]
+    if cls.parent:
+        cls.parent.status_receiver_queue.put(message)
+    for waiter in _waiters.get(cls, ()):
+        waiter.put((cls, message))
+
+
+# node -> queues of whoever waits for the node to finish its transitions (see multicast.py)
+# The tuples are replaced, never changed: the nodes' threads go through them without the lock
+_waiters = {}
+_waiters_lock = threading.Lock()
+
+
+def _add_waiter(node, waiter):
+    with _waiters_lock:
+        _waiters[node] = _waiters.get(node, ()) + (waiter,)
+
+
+def _remove_waiter(node, waiter):
+    with _waiters_lock:
+        waiters = tuple(w for w in _waiters.get(node, ()) if w is not waiter)
+        if waiters:
+            _waiters[node] = waiters
+        else:
+            _waiters.pop(node, None)
+
+
+# called with the node and the state it left, after each of its changes of state (see events.py)
+_state_listeners = []
+
+
+def _state_changed(event):
+    for listener in _state_listeners:
+        listener(event.model, event.transition.source)
+
+
+def _ing_entered(event):
+    ## A transition starts, in the node's history (see history.py)
+    node = event.model
+    if node._history is None:
+        node._history = History()
+    node._history.start(event.event.name, node._clock())
+    _state_changed(event)
+
+
+def _entered(event):
+    ## The end of the transition, if the node comes from an _ing state: its destination or error
+    node = event.model
+    if node._history is not None:
+        node._history.end(node._clock(), event.transition.dest != "error")
+    _state_changed(event)
+
+
+_machines = {}
+
+
+def FSMFactory(model, config=None):
+    '''
+    Construct an FSM from the config, the machine is built once for each distinct config and
+    then shared: the node only gets its initial state
+    '''
+    machine = _machine(config.fsm)
+    machine.set_state(machine.initial, model=model)
+    return machine
+
+
+def _machine(fsm):
+    machine = _machines.get(fsm)
+    if machine is None:
+        machine = _build_machine(fsm)
+        _machines[fsm] = machine
+    return machine
+
+
+def _build_machine(fsm):
+    ## The callbacks are names, resolved on the node's class when the machine runs them,
+    ## so ExecNode and ExecLeaf each get their own _on_enter_ing
+    ## _ing_entered comes first: the _ing states run the whole transition in their on_enter
+    states = []
+    for state in fsm.states:
+        if state in fsm.ing_states:
+            states.append({"name": state, "on_enter": [_ing_entered, "_on_enter_ing"], "on_exit": "_on_exit_ing"})
+        elif state == "error":
+            states.append({"name": state, "on_enter": [_entered, "on_enter_error"]})
+        else:
+            states.append({"name": state, "on_enter": [_entered]})
+
+    # Finally the macchinetta, it isn't attached to any model, the nodes only carry their state
+    machine = Machine(model=None, states=states, initial=fsm.initial, auto_transitions=True, send_event=True)
+
+    for trigger, source, dest in fsm.transitions:
+        machine.add_transition(trigger, source, dest, before="_set_environment")
+
+    return machine
+
+
+def node_memory(node):
+    '''
+    Approximate memory used by a single node, in bytes
+    What it shares with other nodes (parent, children, console, FSM, inherited configuration) isn't counted
+    '''
+    shared = {id(node), id(node.console), id(node.fsm), id(node._table), id(sys.stderr), id(sys.stdout)}
+    shared.update(id(child) for child in node.children)
+    if node.parent:
+        shared.add(id(node.parent))
+        shared.add(id(node.parent.fsm_config))
+        shared.update(id(value) for value in node.parent.fsm_config.config_json.values())
+
+    size = sys.getsizeof(node)
+    to_visit = gc.get_referents(node)
+    while to_visit:
+        obj = to_visit.pop()
+        if id(obj) in shared or isinstance(obj, (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType)):
+            continue
+        shared.add(id(obj))
+        size += sys.getsizeof(obj)
+        to_visit += gc.get_referents(obj)
+    return size
+
+
+def memory_report(topnode):
+    '''
+    Memory used by the nodes of the tree below topnode, overall and per node class
+    '''
+    report = {"nodes": 0, "bytes": 0, "by_class": {}}
+    for node in PreOrderIter(topnode):
+        size = node_memory(node)
+        klass = report["by_class"].setdefault(type(node).__name__, {"nodes": 0, "bytes": 0})
+        for d in [report, klass]:
+            d["nodes"] += 1
+            d["bytes"] += size
+
+    for d in [report] + list(report["by_class"].values()):
+        d["bytes_per_node"] = d["bytes"] / d["nodes"]
+    return report
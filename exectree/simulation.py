@@ -0,0 +1,422 @@
+'''
+Runs a tree on a virtual clock, without threads, to check timeouts and ordering on huge trees in seconds
+
+  from exectree.simulation import Simulation, Script
+  sim = Simulation(open("top_config_simple.json").read(), scripts={
+      "np04_vst/wibs/wib3": {"boot": Script(latency=20)},  # the slow WIB
+      "*": Script(latency=0.5, jitter=0.2, failure_rate=0.01),
+  }, seed=4)
+  sim.command("boot")       # {"state": "error", "elapsed": 15.0}, elapsed in virtual seconds
+
+The nodes go through the same machines, fan-in policies, retries and time budgets as the real ones
+(the fan-in itself is shared with simple.py), but the commands, the messages between the nodes and
+the user code are events on a single queue ordered by virtual time: the same seed gives the same run.
+The leaves don't run any user code, they take the time their Script says, and fail as often.
+'''
+import fnmatch
+import heapq
+import random
+from collections import deque
+
+from . import simple
+from .multicast import _walk
+from .plan import shortest_path
+from .simple import ExecNode, ExecLeaf, CallbackTimeout, NO_RETRY, _state_listeners
+
+
+class Script():
+    '''
+    How a synthetic leaf behaves for a transition: latency seconds (give or take jitter, uniformly) to run
+    its user code, which raises exception once in a while (failure_rate, between 0 and 1)
+    latency can also be a function of the random generator, ex: lambda rng: rng.expovariate(2.)
+    '''
+    def __init__(self, latency=0., jitter=0., failure_rate=0., exception=RuntimeError):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.exception = exception
+
+    def draw(self, rng):
+        ## (duration, exception or None) of one attempt
+        latency = self.latency(rng) if callable(self.latency) else self.latency
+        if self.jitter:
+            latency += rng.uniform(-self.jitter, self.jitter)
+        failure = None
+        if self.failure_rate and rng.random() < self.failure_rate:
+            failure = self.exception("simulated failure")
+        return max(latency, 0.), failure
+
+
+DEFAULT_SCRIPT = Script()
+
+
+class _Silent():
+    ## A console that doesn't print, rich takes most of the time otherwise, even when quiet
+    def log(self, *args, **kwargs):
+        pass
+
+    print = print_json = log
+
+
+class _Inbox():
+    ## The status queue of a simulated node: what's put in it is delivered as an event
+    __slots__ = ["node"]
+
+    def __init__(self, node):
+        self.node = node
+
+    def put(self, message):
+        sim = self.node.sim
+        sim.schedule(sim.hop, self.node._sim_receive, message)
+
+    put_nowait = put
+
+    def empty(self):
+        return True
+
+
+class _Simulated():
+    ## What the simulated nodes and leaves have in common: the command queue, on the clock
+    __slots__ = ()
+
+    def _sim_init(self):
+        self.sim = None
+        self._sim_commands = deque()
+        self._sim_busy = False
+        self._sim_pending = False
+        self._sim_segments = None
+        self._sim_handed_by = None
+
+    def _post_attach(self, parent):
+        if parent.status_receiver_queue is None:
+            parent.status_receiver_queue = _Inbox(parent)
+
+    def _clock(self):
+        return self.sim.now
+
+    def send_command(self, command):
+        self._sim_commands.append(command)
+        if not self._sim_busy:
+            self.sim.schedule(self.sim.hop, self._sim_next)
+
+    def _sim_next(self):
+        ## What the CommandSender's thread does, one command at a time
+        if self._sim_busy or not self._sim_commands:
+            return
+        command = self._sim_commands.popleft()
+        args = ()
+        if isinstance(command, tuple):
+            command, *args = command
+        cmd = getattr(self, command, None)
+        if not cmd:
+            self.console.log(f"ERROR: {self.name}: I don't know of '{command}'")
+            self.sim.schedule(0., self._sim_next)
+            return
+        self._sim_busy = True
+        self._sim_pending = False
+        try:
+            cmd(*args)
+        except Exception as e:
+            self.console.log(f"{self.name} Couldn't execute '{command}': {e}")
+            self._command_rejected(command, e)
+            simple._sequence_end(self)
+            self._sim_segments = None
+            self._sim_pending = False
+        if not self._sim_pending:
+            self._sim_done()
+
+    def run_steps(self, steps, handed_by=None):
+        ## simple._run_steps, one step per event
+        self._sim_pending = True
+        self._sim_segments = deque(deque(segment) for segment in simple._segments(self, steps))
+        self._sim_handed_by = handed_by
+        self._sim_step()
+
+    def _sim_step(self):
+        segment = self._sim_segments[0]
+        if not segment:
+            simple._sequence_end(self)
+            self._sim_segments.popleft()
+            if not self._sim_segments:
+                self._sim_steps_over()
+                return
+            segment = self._sim_segments[0]
+        if self._sim_handed_by is not None and self._sim_handed_by.over:
+            self._sim_steps_over()
+            return
+        if self.children and self not in simple._sequences:
+            simple._sequence_start(self, list(segment))
+        step = segment.popleft()
+        try:
+            getattr(self, step)()
+        except Exception as e:
+            self.console.log(f"{self.name} Couldn't execute '{step}': {e}")
+            self._command_rejected(step, e)
+            self._sim_steps_over()
+
+    def _sim_step_done(self):
+        ## A transition is over: the next step if there's one to go to, otherwise the command is
+        if self._sim_segments is None:
+            self._sim_done()
+        elif self.state == "error":
+            self._sim_steps_over()
+        else:
+            self.sim.schedule(0., self._sim_step)
+
+    def _sim_steps_over(self):
+        simple._sequence_end(self)
+        self._sim_segments = None
+        self._sim_handed_by = None
+        self._sim_done()
+
+    def _sim_done(self):
+        ## The command is over (cmd() would have returned), on to the next one
+        self._sim_busy = False
+        self._sim_pending = False
+        if self._sim_commands:
+            self.sim.schedule(0., self._sim_next)
+
+    def _sim_reset(self):
+        self._history = None
+        self._error = None
+        self._sim_commands.clear()
+        self._sim_busy = False
+        self._sim_pending = False
+        self._sim_segments = None
+        self._sim_handed_by = None
+        simple._sequences.pop(self, None)
+
+
+class SimNode(_Simulated, ExecNode):
+    '''
+    An ExecNode waiting for its children on the virtual clock
+    '''
+    __slots__ = ["sim", "_sim_commands", "_sim_busy", "_sim_pending", "_sim_segments", "_sim_handed_by",
+                 "_fan_in", "_sim_deadline"]
+
+    def __init__(self, *args, **kwargs):
+        self._sim_init()
+        self._fan_in = None
+        self._sim_deadline = None
+        super().__init__(*args, **kwargs)
+
+    def _on_enter_ing(self, event):
+        trigger = self.event.event.name
+        if trigger.startswith("end_"):
+            return
+        if not self.children:
+            raise RuntimeError(f"{self.name} doesn't have children to send commands to")
+        self._sim_pending = True
+        self._fan_in = fan_in = simple._fan_in_start(self, trigger, self.sim.now)
+        self._sim_deadline = self.sim.schedule(self.sim.fan_in_timeout, self._sim_finish)
+        if fan_in.verdict is not None:
+            # the children had already answered (run_steps)
+            self._sim_finish()
+
+    def _sim_receive(self, message):
+        fan_in = self._fan_in
+        if simple._keep_for_later(self, fan_in and fan_in.trigger, message):
+            return
+        if fan_in is None:
+            return # stale, nobody is waiting for it
+        if simple._fan_in_receive(self, fan_in, message) is not None:
+            self._sim_finish()
+
+    def _sim_finish(self):
+        fan_in, self._fan_in = self._fan_in, None
+        self.sim.cancel(self._sim_deadline)
+        self._sim_deadline = None
+        try:
+            simple._fan_in_finish(self, fan_in, self.sim.now)
+        except Exception as e:
+            # ex: the node was put on error by its parent in the meantime
+            self.console.log(f"{self.name} Couldn't execute '{fan_in.trigger}': {e}")
+        self._sim_step_done()
+
+    def _sim_reset(self):
+        super()._sim_reset()
+        self._fan_in = None
+        self._sim_deadline = None
+
+
+class SimLeaf(_Simulated, ExecLeaf):
+    '''
+    A leaf whose user code is a Script: it only takes time, and fails now and then
+    '''
+    __slots__ = ["sim", "_sim_commands", "_sim_busy", "_sim_pending", "_sim_segments", "_sim_handed_by",
+                 "_sim_attempts", "_sim_trigger"]
+
+    def __init__(self, *args, **kwargs):
+        self._sim_init()
+        self._sim_attempts = None
+        self._sim_trigger = None
+        super().__init__(*args, **kwargs)
+
+    def _on_enter_ing(self, event):
+        self._sim_pending = True
+        self._sim_trigger = self.event.event.name
+        self._sim_attempts = []
+        self._sim_attempt()
+
+    def _sim_attempt(self):
+        sim = self.sim
+        duration, failure = sim.script(self, self._sim_trigger).draw(sim.rng)
+        budget = self.fsm_config.timeouts.get(self._sim_trigger)
+        if budget is not None and duration > budget:
+            duration = budget
+            failure = CallbackTimeout(f"{self.name} was still busy with {self.state} after {budget}s")
+        sim.schedule(duration, self._sim_attempt_done, sim.now, failure)
+
+    def _sim_attempt_done(self, start, failure):
+        sim = self.sim
+        attempts = self._sim_attempts
+        attempts.append(simple._attempt(len(attempts)+1, start, sim.now-start, failure))
+        if failure is None:
+            simple._user_code_succeeded(self, attempts)
+            self._sim_step_done()
+            return
+
+        retry = self.fsm_config.retry.get(self._sim_trigger, NO_RETRY)
+        if len(attempts) < retry.attempts and retry.is_retryable(failure):
+            self.console.log(f"{self.name} attempt {len(attempts)} at {self.state} failed ({failure}), retrying")
+            sim.schedule(retry.delay(len(attempts)), self._sim_attempt)
+            return
+        simple._user_code_failed(self, attempts, failure, f"{type(failure).__name__}: {failure} (simulated)\n")
+        self._sim_step_done()
+
+
+class Simulation():
+    '''
+    A tree of simulated nodes (see the top of the file), built from a json configuration (a string)
+    scripts: {path glob: Script, or {trigger: Script}}, the first match for the path and trigger wins,
+    DEFAULT_SCRIPT (instantaneous) otherwise
+    hop: virtual seconds for a command or a message to get from a node to another
+    fan_in_timeout: how long the nodes wait for their children, simple.FAN_IN_TIMEOUT by default
+    trace: records (time, node, source, state) for every change of state in self.trace
+    '''
+    def __init__(self, config, scripts=None, seed=0, console=None, hop=0., fan_in_timeout=None, trace=False, use_cache=True):
+        self.scripts = list((scripts or {}).items())
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.hop = hop
+        self.fan_in_timeout = simple.FAN_IN_TIMEOUT if fan_in_timeout is None else fan_in_timeout
+        self.now = 0.
+        self.events = [] # heap of [time, sequence, callback, args], callback None once cancelled
+        self.sequence = 0
+        self.trace = [] if trace else None
+        self._scripts = {} # (node, trigger) -> Script
+
+        console = console or _Silent()
+        plan = simple._compile(config, use_cache)
+        self.tree = SimNode(name=plan.name, fsm_config=plan.config, console=console)
+        simple._construct_tree(plan, self.tree, console, SimLeaf, SimNode)
+        self.nodes = []
+        paths = {}
+        for node, path in _walk(self.tree, self.tree.name):
+            node.sim = self
+            paths[node] = path
+            self.nodes.append(node)
+        self.paths = paths
+        # no user code to check for
+        self.tree._create_fsm()
+        if trace:
+            _state_listeners.append(self._record)
+
+
+    def _record(self, node, source):
+        if node.sim is self:
+            self.trace.append((self.now, node, source, node.state))
+
+
+    def script(self, node, trigger):
+        script = self._scripts.get((node, trigger))
+        if script is None:
+            script = DEFAULT_SCRIPT
+            for pattern, value in self.scripts:
+                if isinstance(value, dict):
+                    value = value.get(trigger)
+                if value is not None and fnmatch.fnmatchcase(self.paths[node], pattern):
+                    script = value
+                    break
+            self._scripts[(node, trigger)] = script
+        return script
+
+
+    def schedule(self, delay, callback, *args):
+        ## Returns the event, for cancel()
+        event = [self.now+delay, self.sequence, callback, args]
+        heapq.heappush(self.events, event)
+        self.sequence += 1
+        return event
+
+
+    def cancel(self, event):
+        ## It stays in the heap, but doesn't run nor move the clock
+        if event is not None:
+            event[2] = None
+
+
+    def send(self, command, node=None):
+        ## Queues command on node (the top node by default), run() makes it happen
+        (node or self.tree).send_command(command)
+
+
+    def run(self, until=None, condition=None):
+        '''
+        Processes the events in order until there are none left, the virtual clock reaches until,
+        or condition() is false
+        Returns the virtual time
+        '''
+        events = self.events
+        while events and (condition is None or condition()):
+            if until is not None and events[0][0] > until:
+                self.now = until
+                return self.now
+            when, _, callback, args = heapq.heappop(events)
+            if callback is None:
+                continue
+            self.now = when
+            callback(*args)
+        if until is not None:
+            self.now = max(self.now, until)
+        return self.now
+
+
+    def command(self, command, node=None):
+        '''
+        Sends the command and runs until everything settled
+        Returns the state of the node and the virtual seconds it took the node (the stragglers may take longer)
+        '''
+        node = node or self.tree
+        start = self.now
+        self.send(command, node)
+        self.run(condition=lambda: node._sim_busy or node._sim_commands)
+        result = {"state": node.state, "elapsed": self.now-start}
+        self.run()
+        return result
+
+
+    def run_to(self, target, node=None):
+        ## ExecNode.run_to, on the virtual clock
+        node = node or self.tree
+        steps = shortest_path(node.fsm_config.transitions, node.state, target)
+        return {"steps": steps, **self.command(("run_steps", steps), node)}
+
+
+    def reset(self, seed=None):
+        ## Back to the initial state with an empty clock, to run another scenario on the same tree
+        self.seed = self.seed if seed is None else seed
+        self.rng = random.Random(self.seed)
+        self.now = 0.
+        self.events = []
+        self.sequence = 0
+        if self.trace is not None:
+            self.trace = []
+        for node in self.nodes:
+            node._sim_reset()
+            node.fsm.set_state(node.fsm_config.fsm.initial, model=node)
+
+
+    def close(self):
+        if self.trace is not None and self._record in _state_listeners:
+            _state_listeners.remove(self._record)
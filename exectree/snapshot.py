@@ -0,0 +1,183 @@
+'''
+The states of a whole tree at one instant, without stopping anyone
+
+  snapshot = top.snapshot()
+  snapshot.state(node), snapshot.counts(), snapshot.is_consistent(node), snapshot.changed(older_snapshot)
+
+Every tree has a StateTable: an array with a small code per node, written by the node when its state
+changes (a single store, nobody waits for anybody). A snapshot is a copy of that array, made in one go
+while holding the GIL: every state in it is the one the node had at the same instant, which reading
+node.state while walking the tree doesn't give. Copying 10k codes takes microseconds.
+Snapshots are immutable and numbered (epoch) in the order they were taken, on each table.
+The index of a node that leaves the tree goes to the next one that joins it, the table only grows
+with the tree.
+'''
+import itertools
+import threading
+import time
+from array import array
+from collections import Counter
+
+# state name <-> code, shared by all the tables, 0 is no state yet
+_codes = {None: 0}
+_names = [None]
+_codes_lock = threading.Lock()
+
+
+def _code(state):
+    code = _codes.get(state)
+    if code is None:
+        with _codes_lock:
+            code = _codes.get(state)
+            if code is None:
+                code = len(_names)
+                _names.append(state)
+                _codes[state] = code
+    return code
+
+
+class StateTable():
+    '''
+    The states of the nodes of one tree, indexed by node._index
+    The index of a node that left the tree (None in nodes) goes to the next node registered, so that
+    reloads don't make the table grow: the nodes that leave take their states to a table of their own
+    '''
+    __slots__ = ["codes", "nodes", "free", "lock", "epochs", "_frozen"]
+
+    def __init__(self):
+        self.codes = array("H")
+        self.nodes = []
+        self.free = [] # indexes of the nodes that left
+        self.lock = threading.Lock() # for the registrations, not the states
+        self.epochs = itertools.count()
+        self._frozen = None # (nodes, indexes of what isn't shown) as of the last change of structure
+
+
+    def register(self, node):
+        with self.lock:
+            if self.free:
+                index = self.free.pop()
+                self.nodes[index] = node
+                self.codes[index] = 0
+            else:
+                index = len(self.nodes)
+                self.nodes.append(node)
+                self.codes.append(0)
+            self._frozen = None
+        return index
+
+
+    def release(self, index):
+        with self.lock:
+            self.nodes[index] = None
+            self.codes[index] = 0
+            self.free.append(index)
+            self._frozen = None
+
+
+    def adopt(self, node):
+        ## The nodes below node (included) move over from the table they were in: the one they were
+        ## built with, or the one of the tree they just left or joined (see ExecNode._post_detach)
+        from anytree import PreOrderIter
+        for n in PreOrderIter(node):
+            old, old_index = n._table, n._index
+            n._table = self
+            n._index = self.register(n)
+            old.release(old_index)
+            self.set(n._index, getattr(n, "_state", None))
+
+
+    def set(self, index, state):
+        self.codes[index] = _code(state)
+
+
+    def snapshot(self, clock=time.time):
+        frozen = self._frozen
+        if frozen is None:
+            with self.lock:
+                nodes = tuple(self.nodes)
+                hidden = tuple(i for i, node in enumerate(nodes) if node is None)
+                frozen = self._frozen = (nodes, hidden)
+        # one C call: the states of all the nodes at the same instant
+        codes = self.codes[:len(frozen[0])]
+        return Snapshot(next(self.epochs), clock(), frozen[0], frozen[1], codes)
+
+
+class Snapshot():
+    '''
+    The states of the nodes of a tree as they were when it was taken, read-only
+    Nodes that left the tree aren't in it
+    '''
+    __slots__ = ["epoch", "time", "_nodes", "_hidden", "_codes"]
+
+    def __init__(self, epoch, time, nodes, hidden, codes):
+        self.epoch = epoch
+        self.time = time
+        self._nodes = nodes
+        self._hidden = hidden
+        self._codes = codes
+
+
+    def __len__(self):
+        return len(self._nodes) - len(self._hidden)
+
+
+    def state(self, node):
+        index = node._index
+        if index >= len(self._nodes) or self._nodes[index] is not node:
+            raise KeyError(f"{node.name} isn't in this snapshot")
+        return _names[self._codes[index]]
+
+
+    def __iter__(self):
+        ## (node, state) in the order the nodes were created
+        for node, code in zip(self._nodes, self._codes):
+            if node is not None:
+                yield node, _names[code]
+
+
+    def counts(self, topnode=None):
+        '''
+        {state: number of nodes}, of the whole tree or of the nodes below topnode (included)
+        '''
+        if topnode is None or topnode.parent is None:
+            counts = Counter(self._codes)
+            for index in self._hidden:
+                counts[self._codes[index]] -= 1
+        else:
+            from anytree import PreOrderIter
+            counts = Counter(self._codes[node._index] for node in PreOrderIter(topnode))
+        return {_names[code]: n for code, n in counts.items() if n}
+
+
+    def is_consistent(self, node):
+        ## As ExecNode.is_consistent: are the included nodes below node in its state, when the snapshot was taken
+        state = self.state(node)
+        for child in node.children:
+            if child.fsm_config.included:
+                if child.children and not self.is_consistent(child):
+                    return False
+                if self.state(child) != state:
+                    return False
+        return True
+
+
+    def changed(self, older):
+        ## {node: (state then, state now)} of the nodes whose state isn't the same as in an older snapshot of the tree,
+        ## None then for the nodes that weren't in it
+        if older._nodes is self._nodes:
+            # nothing joined or left the tree in between, the indexes are the same
+            if older._codes == self._codes:
+                return {}
+            return {node: (_names[old], _names[new])
+                    for node, old, new in zip(self._nodes, older._codes, self._codes)
+                    if old != new and node is not None}
+        then = {node: code for node, code in zip(older._nodes, older._codes) if node is not None}
+        changes = {}
+        for node, new in zip(self._nodes, self._codes):
+            if node is None:
+                continue
+            old = then.get(node)
+            if old != new:
+                changes[node] = (None if old is None else _names[old], _names[new])
+        return changes
@@ -1,4 +1,4 @@
-import executabletrees as ET
+import exectree.executable as ET
 from anytree import Node, search
 from rich.console import Console
 from random import randrange
@@ -1,24 +1,31 @@
-import simpleExecTree as ET
-from anytree import Node, search
-import threading
+import exectree.simple as ET
+from anytree import Node
 from rich.console import Console
 from random import randrange
 import time
 
-c = Console()
-
-exectree = ET.loads("top_config_simple.json", c)
-wnodes = []
-wnodes += search.findall_by_attr(exectree, "wib1", name="name")
-wnodes += search.findall_by_attr(exectree, "wib2", name="name")
-wnodes += search.findall_by_attr(exectree, "wib3", name="name")
-
 # There are 2 ways to deal with transitions:
 #  -1 Either the transitions are long, and there is a state of the FSM called  "command"+"-ing".
 #        In this case, once we are done with the command, we need to "end_"+"command" to move the FSM to the next state
 #  -2 Either the transition are short, and the FSM moves to the next state when we call it, but the command may not have finished.
 
-class WIBNode(ET.ExecLeaf):
+class WIBBaseNode(ET.ExecLeaf):
+    # create_fsms() checks that the leaves can handle every transition of their FSM,
+    # this is what the WIBs do when there's nothing special to do
+    def _nothing_to_do(self):
+        print(f"{self.name} has nothing to do in {self.state}")
+
+    user_on_enter_boot_ing      = _nothing_to_do
+    user_on_enter_init_ing      = _nothing_to_do
+    user_on_enter_conf_ing      = _nothing_to_do
+    user_on_enter_start_ing     = _nothing_to_do
+    user_on_enter_pause_ing     = _nothing_to_do
+    user_on_enter_resume_ing    = _nothing_to_do
+    user_on_enter_stop_ing      = _nothing_to_do
+    user_on_enter_scrap_ing     = _nothing_to_do
+    user_on_enter_terminate_ing = _nothing_to_do
+
+class WIBNode(WIBBaseNode):
     def __init__(self, name:str, parent=None, fsm_config=None, console=None):
         super().__init__(name=name, parent=parent,
                          fsm_config=fsm_config,
@@ -29,7 +36,7 @@ class WIBNode(ET.ExecLeaf):
         time.sleep(2)
         print("Sane WIBNode user code DONE!")
 
-class WIBBuggyNode(ET.ExecLeaf):
+class WIBBuggyNode(WIBBaseNode):
     def __init__(self, name:str, parent=None, fsm_config=None, console=None):
         super().__init__(name=name, parent=parent,
                          fsm_config=fsm_config,
@@ -40,7 +47,7 @@ class WIBBuggyNode(ET.ExecLeaf):
         raise RuntimeError("whatnot")
         print("Buggy WIBNode user code DONE!")
 
-class WIBSlowNode(ET.ExecLeaf):
+class WIBSlowNode(WIBBaseNode):
     def __init__(self, name:str, parent=None, fsm_config=None, console=None):
         super().__init__(name=name, parent=parent,
                          fsm_config=fsm_config,
@@ -52,50 +59,46 @@ class WIBSlowNode(ET.ExecLeaf):
         raise RuntimeError("whatnot")
         print("Slow WIBNode user code DONE!")
 
-wibs = []
-wnodes[0].quit()
-wnodes[1].quit()
-wnodes[2].quit()
-WIBNode     (wnodes[0].name+"real", wnodes[0].parent, wnodes[0].fsm_config.config_json, wnodes[0].console)
-WIBBuggyNode(wnodes[1].name+"real", wnodes[1].parent, wnodes[1].fsm_config.config_json, wnodes[1].console)
-WIBSlowNode (wnodes[2].name+"real", wnodes[2].parent, wnodes[2].fsm_config.config_json, wnodes[2].console)
-wnodes[0].parent = None
-wnodes[1].parent = None
-wnodes[2].parent = None
+if __name__ == "__main__":
+    c = Console()
+
+    # The leaves get their class from their value in the configuration ("wib2": "buggy-wib")
+    exectree = ET.loads("top_config_simple.json", c, leaf_class={
+        "wib": WIBNode,
+        "buggy-wib": WIBBuggyNode,
+        "slow-wib": WIBSlowNode,
+    })
 
-# AFTER we register, we create the fsm on the tree
-exectree.create_fsms()
-exectree.print_status(c)
-exectree.print_fsm(c)
-# sending commands... 
-exectree.send_command("boot")
-for _ in range(60):
-    time.sleep(1)
+    # AFTER we register, we create the fsm on the tree
+    exectree.create_fsms()
+    exectree.print_status(c)
+    exectree.print_fsm(c)
+    # sending commands... 
+    exectree.send_command("boot")
+    for _ in range(60):
+        time.sleep(1)
+        exectree.print_status(c)
+    # exectree.send_command("init")
+    time.sleep(10)
     exectree.print_status(c)
-# exectree.send_command("init")
-time.sleep(10)
-exectree.print_status(c)
-# exectree.print_fsm(c)
-# exectree.send_command("conf")
-# time.sleep(2)
-# exectree.print_fsm(c)
-# exectree.send_command("start")
-# time.sleep(2)
-# exectree.print_fsm(c)
-for thread in threading.enumerate(): 
-    print(thread.name)
-exectree.quit()
-for thread in threading.enumerate(): 
-    print(thread.name)
-# time.sleep(2)
-# exectree.send_command("conf")
-# time.sleep(2)
-# exectree.print_fsm(c)
-# time.sleep(2)
-# exectree.send_command("start")
-# time.sleep(2)
-# exectree.print_fsm(c)
-# time.sleep(2)
-# exectree.print_status(c)
-# exectree.print_fsm(c)
-# exectree.quit()
+    # exectree.print_fsm(c)
+    # exectree.send_command("conf")
+    # time.sleep(2)
+    # exectree.print_fsm(c)
+    # exectree.send_command("start")
+    # time.sleep(2)
+    # exectree.print_fsm(c)
+    stuck = exectree.quit(timeout=2.)
+    print(f"Nodes that didn't stop in time: {[node.name for node in stuck]}")
+    # time.sleep(2)
+    # exectree.send_command("conf")
+    # time.sleep(2)
+    # exectree.print_fsm(c)
+    # time.sleep(2)
+    # exectree.send_command("start")
+    # time.sleep(2)
+    # exectree.print_fsm(c)
+    # time.sleep(2)
+    # exectree.print_status(c)
+    # exectree.print_fsm(c)
+    # exectree.quit()